@@ -133,3 +133,7 @@ QDRANT_VECTOR_SIZE = 768
 
 QDRANT_DISTANCE = "Cosine"
 
+QDRANT_QUANTIZATION = "scalar"
+
+QDRANT_VECTOR_DATATYPE = "float16"
+
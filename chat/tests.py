@@ -1,3 +1,619 @@
-from django.test import TestCase
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase
+
+from chat import views
+
+
+# The substring checks _math_tags replaced; the keyword scan must agree with them
+def _old_looks_like_global_aggregation(question):
+    q = (question or "").lower()
+    return any(a in q for a in views._AGG_KEYWORDS) and any(t in q for t in views._TARGET_KEYWORDS)
+
+
+def _old_pick_math_op(question):
+    q = (question or "").lower()
+    if ("max" in q or "maximum" in q or "highest" in q) and ("salary" in q or "basic" in q):
+        return "max_salary"
+    if ("min" in q or "minimum" in q or "lowest" in q) and ("salary" in q or "basic" in q):
+        return "min_salary"
+    if ("total" in q or "sum" in q) and ("salary" in q or "basic" in q):
+        return "total_salary"
+    if ("average" in q or "avg" in q or "mean" in q) and ("salary" in q or "basic" in q):
+        return "avg_salary"
+    if "count" in q and ("employee" in q or "employees" in q):
+        return "count_employees"
+    return "salary_stats"
+
+
+class MathKeywordTests(SimpleTestCase):
+    QUESTIONS = [
+        "",
+        None,
+        "Who is N5?",
+        "What is the total salary of employees?",
+        "average BASICSALARY",
+        "Highest paid employee",
+        "lowest wage",
+        "count employees",
+        "How many employees are there?",
+        "Give me a summary of the employees",  # "sum" inside "summary"
+        "admin pay",  # "min" inside "admin"
+        "top 5 salaries",
+        "top-10 employees by salary",
+        "median basicsalary",
+        "MAXIMUM Basic",
+        "minimum and maximum salary",
+        "mean of the employee count",
+        "salary",
+        "total",
+    ]
+
+    def assertSameAsSubstring(self, q):
+        self.assertEqual(views._looks_like_global_aggregation(q), _old_looks_like_global_aggregation(q), q)
+        self.assertEqual(views._pick_math_op(q), _old_pick_math_op(q), q)
+
+    def test_questions(self):
+        for q in self.QUESTIONS:
+            self.assertSameAsSubstring(q)
+
+    def test_keyword_pairs(self):
+        keywords = list(views._KEYWORD_TAGS) + ["x", "summary", "admin"]
+        for a, b in product(keywords, repeat=2):
+            for sep in ("", " "):
+                self.assertSameAsSubstring(a + sep + b)
+
+    def test_examples(self):
+        self.assertTrue(views._looks_like_global_aggregation("What is the total salary of employees?"))
+        self.assertFalse(views._looks_like_global_aggregation("Who is N5?"))
+        self.assertEqual(views._pick_math_op("highest basicsalary"), "max_salary")
+        self.assertEqual(views._pick_math_op("count employees"), "count_employees")
+        self.assertEqual(views._pick_math_op("top 5 employees"), "salary_stats")
+
+
+class AdaptiveBatcherTests(SimpleTestCase):
+    def test_initial_is_clamped(self):
+        self.assertEqual(views._AdaptiveBatcher(1000, minimum=2, maximum=64).size, 64)
+        self.assertEqual(views._AdaptiveBatcher(0, minimum=2, maximum=64).size, 2)
+        self.assertEqual(views._AdaptiveBatcher(5, minimum=0, maximum=0).size, 1)
+
+    def test_grows_after_successes(self):
+        b = views._AdaptiveBatcher(8, minimum=1, maximum=20, grow_after=2)
+        b.success()
+        self.assertEqual(b.size, 8)
+        b.success()
+        self.assertEqual(b.size, 16)
+        b.success()
+        b.success()
+        self.assertEqual(b.size, 20)
+
+    def test_failure_halves_and_resets_streak(self):
+        b = views._AdaptiveBatcher(8, minimum=3, maximum=64, grow_after=2)
+        b.success()
+        b.failure()
+        self.assertEqual(b.size, 4)
+        b.success()
+        self.assertEqual(b.size, 4)
+        b.failure()
+        b.failure()
+        self.assertEqual(b.size, 3)
+
+
+class SniffJsonlTests(SimpleTestCase):
+    def test_object_first_line(self):
+        self.assertTrue(views._sniff_jsonl(b'{"prompt": "a"}\n{"prompt": "b"}\n'))
+
+    def test_leading_blank_lines(self):
+        self.assertTrue(views._sniff_jsonl(b'\n  \n{"prompt": "a"}\n'))
+
+    def test_empty(self):
+        self.assertTrue(views._sniff_jsonl(b""))
+
+    def test_not_json(self):
+        self.assertFalse(views._sniff_jsonl(b"id,prompt\n1,a\n"))
+
+    def test_json_but_not_object(self):
+        self.assertFalse(views._sniff_jsonl(b'[1, 2]\n{"prompt": "a"}\n'))
+
+    def test_only_later_lines_are_ignored(self):
+        self.assertTrue(views._sniff_jsonl(b'{"prompt": "a"}\nnot json\n'))
+
+    def test_first_line_cut_by_sniff_window(self):
+        head = b'{"prompt": "' + b"x" * views.UPLOAD_SNIFF_BYTES
+        self.assertTrue(views._sniff_jsonl(head[: views.UPLOAD_SNIFF_BYTES]))
+
+    def test_short_incomplete_line_is_rejected(self):
+        self.assertFalse(views._sniff_jsonl(b'{"prompt": "a'))
+
+    def test_utf8_bom(self):
+        head = b'\xef\xbb\xbf{"prompt": "a"}\n'
+        self.assertTrue(views._sniff_jsonl(head))
+        with mock.patch.object(views, "orjson", None):  # same answer without orjson
+            self.assertTrue(views._sniff_jsonl(head))
+
+
+class UploadTestCase(SimpleTestCase):
+    """api_upload_jsonl with Ollama embeddings and Qdrant writes mocked out."""
+
+    def setUp(self):
+        self.upserts = []  # (collection, [point ids], wait) per request
+        self.threshold = None
+        self.thresholds_set = []
+        patches = [
+            mock.patch.object(views, "_ollama_embed_batch", side_effect=self.embed),
+            mock.patch.object(views, "_qdrant_upsert_batch", side_effect=self.upsert),
+            mock.patch.object(views, "_qdrant_indexing_threshold", side_effect=lambda c: self.threshold),
+            mock.patch.object(views, "_qdrant_set_indexing_threshold", side_effect=self.set_threshold),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def embed(self, model, texts):
+        return [[float(len(t)), 1.0] for t in texts]
+
+    def upsert(self, collection, points, wait=False):
+        self.upserts.append((collection, [p["id"] for p in points], wait))
+
+    def set_threshold(self, collection, value):
+        self.thresholds_set.append(value)
+
+    def upload(self, data, **fields):
+        if isinstance(data, list):
+            data = "".join(json.dumps(d) + "\n" if isinstance(d, dict) else d + "\n" for d in data).encode()
+        fields["file"] = SimpleUploadedFile("rows.jsonl", data)
+        return views.api_upload_jsonl(RequestFactory().post("/api/upload-jsonl", fields))
+
+    def upload_json(self, data, **fields):
+        r = self.upload(data, **fields)
+        self.assertEqual(r.status_code, 200, r.content)
+        return json.loads(r.content)
+
+    def upload_progress(self, data, **fields):
+        r = self.upload(data, progress="1", **fields)
+        self.assertTrue(r.streaming)
+        return [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+
+
+class UploadBomTests(UploadTestCase):
+    def test_bom_keeps_first_line(self):
+        data = b'\xef\xbb\xbf{"id": 1, "prompt": "a"}\n{"id": 2, "prompt": "b"}\n'
+        body = self.upload_json(data)
+        self.assertEqual((body["success"], body["failed"]), (2, 0))
+
+
+class ExtractSalaryTests(SimpleTestCase):
+    def test_numbers(self):
+        self.assertEqual(views._extract_salary({"BASICSALARY": 1200}), 1200.0)
+        self.assertEqual(views._extract_salary({"salary": 12.5}), 12.5)
+
+    def test_strings(self):
+        self.assertEqual(views._extract_salary({"BASICSALARY": " 1,234.5 "}), 1234.5)
+        self.assertEqual(views._extract_salary({"BASICSALARY": "", "SALARY": "7"}), 7.0)
+
+    def test_huge_int(self):
+        self.assertEqual(views._extract_salary({"BASICSALARY": 10**400}), math.inf)
+        self.assertEqual(views._extract_salary({"BASICSALARY": -(10**400)}), -math.inf)
+
+    def test_bool_is_not_a_number(self):
+        self.assertIsNone(views._extract_salary({"BASICSALARY": True}))
+        self.assertEqual(views._extract_salary({"BASICSALARY": False, "SALARY": 3}), 3.0)
+
+    def test_nan(self):
+        self.assertTrue(math.isnan(views._extract_salary({"BASICSALARY": float("nan")})))
+        self.assertTrue(math.isnan(views._extract_salary({"BASICSALARY": "NaN"})))
+
+    def test_prompt_fallback(self):
+        self.assertEqual(views._extract_salary({"prompt": "EMPLOYEEID: 1 | BASICSALARY: 950.25"}), 950.25)
+        self.assertEqual(views._extract_salary({"BASICSALARY": "n/a", "prompt": "basicsalary:10"}), 10.0)
+        self.assertIsNone(views._extract_salary({"prompt": "no salary here"}))
+        self.assertIsNone(views._extract_salary({}))
+
+
+class RagContextTests(SimpleTestCase):
+    def hit(self, i, prompt):
+        return {"id": f"id{i}", "score": 1.0 - i / 10, "payload": {"prompt": prompt}}
+
+    def test_all_fit(self):
+        context, sources = views._rag_context([self.hit(0, "a"), self.hit(1, ""), self.hit(2, " b ")])
+        self.assertEqual(context, "[1] a\n\n[3] b")
+        self.assertEqual([s["id"] for s in sources], ["id0", "id2"])
+
+    def test_budget_drops_the_rest(self):
+        hits = [self.hit(0, "a" * 10), self.hit(1, "b" * 10), self.hit(2, "c")]
+        with mock.patch.object(views, "MAX_RAG_CONTEXT_CHARS", 30):
+            context, sources = views._rag_context(hits)
+        # 14 chars + "\n\n" leave exactly room for the second block; the third is dropped
+        self.assertEqual(context, "[1] aaaaaaaaaa\n\n[2] bbbbbbbbbb")
+        with mock.patch.object(views, "MAX_RAG_CONTEXT_CHARS", 29):
+            context, sources = views._rag_context(hits)
+        self.assertEqual(context, "[1] aaaaaaaaaa")
+        self.assertEqual([s["id"] for s in sources], ["id0"])
+
+    def test_first_block_is_cut_to_fit(self):
+        with mock.patch.object(views, "MAX_RAG_CONTEXT_CHARS", 8):
+            context, sources = views._rag_context([self.hit(0, "a" * 100), self.hit(1, "b")])
+        self.assertEqual(context, "[1] aaaa")
+        self.assertEqual(len(sources), 1)
+
+
+def _http_error(status):
+    resp = requests.Response()
+    resp.status_code = status
+    return requests.exceptions.HTTPError(f"{status} Error", response=resp)
+
+
+class UploadUpsertTests(UploadTestCase):
+    def rows(self, n, bad=()):
+        return [{"id": "bad" if i in bad else i, "prompt": f"row {i}"} for i in range(n)]
+
+    def test_batches_and_waits_on_last(self):
+        with mock.patch.object(views, "QDRANT_UPSERT_BATCH", 4):
+            body = self.upload_json(self.rows(10))
+        self.assertEqual((body["success"], body["failed"]), (10, 0))
+        self.assertEqual([len(ids) for _c, ids, _w in self.upserts], [4, 4, 2])
+        self.assertEqual([w for _c, _ids, w in self.upserts], [False, False, True])
+
+    def test_rejected_point_fails_alone(self):
+        def upsert(collection, points, wait=False):
+            if any(p["id"] == "bad" for p in points):
+                raise _http_error(400)
+            self.upsert(collection, points, wait)
+
+        with mock.patch.object(views, "_qdrant_upsert_batch", side_effect=upsert):
+            body = self.upload_json(self.rows(128, bad={37}))
+        self.assertEqual((body["success"], body["failed"]), (127, 1))
+        self.assertEqual([e["line"] for e in body["errors"]], [38])
+        self.assertEqual(sum(len(ids) for _c, ids, _w in self.upserts), 127)
+
+    def test_server_error_fails_the_whole_request(self):
+        with mock.patch.object(views, "_qdrant_upsert_batch", side_effect=_http_error(503)) as upsert:
+            body = self.upload_json(self.rows(10))
+        self.assertEqual((body["success"], body["failed"]), (0, 10))
+        self.assertEqual(upsert.call_count, 1)
+        self.assertEqual(body["errors"][0]["error"], "lines 1-10: 503 Error")
+
+
+class UploadDedupeTests(UploadTestCase):
+    def test_duplicate_texts_are_embedded_once(self):
+        rows = [{"id": i, "prompt": "same" if i % 2 else f"row {i}"} for i in range(1, 7)]
+        rows.append({"id": 7, "prompt": "same", "model": "other-model"})
+        with mock.patch.object(views, "_ollama_embed_batch", side_effect=self.embed) as embed:
+            body = self.upload_json(rows)
+        self.assertEqual((body["success"], body["failed"]), (7, 0))
+        embedded = sorted((c.args[0], t) for c in embed.call_args_list for t in c.args[1])
+        self.assertEqual(embedded, sorted([
+            (views.EMBED_MODEL, "row 2"), (views.EMBED_MODEL, "row 4"), (views.EMBED_MODEL, "row 6"),
+            (views.EMBED_MODEL, "same"), ("other-model", "same"),
+        ]))
+        self.assertEqual([pid for _c, ids, _w in self.upserts for pid in ids], [str(i) for i in range(1, 8)])
+
+
+class UploadWindowTests(UploadTestCase):
+    def test_windows_flush_and_report_progress(self):
+        rows = [{"id": i, "prompt": f"row {i}"} for i in range(1, 11)]
+        with mock.patch.object(views, "UPLOAD_WINDOW_ROWS", 4), \
+                mock.patch.object(views, "_ollama_embed_batch", side_effect=self.embed) as embed:
+            lines = self.upload_progress(rows)
+        self.assertEqual(lines[:2], [
+            {"line": 4, "success": 4, "failed": 0},
+            {"line": 8, "success": 8, "failed": 0},
+        ])
+        self.assertEqual((lines[-1]["success"], lines[-1]["failed"]), (10, 0))
+        self.assertEqual(len(lines), 3)
+        # Each window is embedded on its own
+        self.assertEqual([len(c.args[1]) for c in embed.call_args_list], [4, 4, 2])
+
+    def test_without_progress_returns_only_the_summary(self):
+        with mock.patch.object(views, "UPLOAD_WINDOW_ROWS", 4):
+            body = self.upload_json([{"id": i, "prompt": f"row {i}"} for i in range(1, 11)])
+        self.assertEqual((body["success"], body["failed"], body["errors"]), (10, 0, []))
+
+
+class UploadIndexingTests(UploadTestCase):
+    rows = [{"id": i, "prompt": f"row {i}"} for i in range(1, 11)]
+
+    def setUp(self):
+        super().setUp()
+        self.threshold = 20000
+        p = mock.patch.object(views, "UPLOAD_WINDOW_ROWS", 4)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_deferred_and_restored(self):
+        self.upload_json(self.rows)
+        self.assertEqual(self.thresholds_set, [0, 20000])
+
+    def test_single_window_is_not_deferred(self):
+        self.upload_json(self.rows[:3])
+        self.assertEqual(self.thresholds_set, [])
+
+    def test_restored_when_a_window_raises(self):
+        real = views._embed_unique_texts
+        calls = []
+
+        def embed_unique(keys, batcher):
+            calls.append(keys)
+            if len(calls) == 2:
+                raise RuntimeError("boom")
+            return real(keys, batcher)
+
+        with mock.patch.object(views, "_embed_unique_texts", side_effect=embed_unique):
+            r = self.upload(self.rows)
+        self.assertEqual(r.status_code, 500)
+        self.assertEqual(self.thresholds_set, [0, 20000])
+
+
+class UploadTruncationTests(UploadTestCase):
+    def test_embed_failures_stop_the_upload(self):
+        rows = [{"id": i, "prompt": f"row {i}"} for i in range(1, 101)]
+        with mock.patch.object(views, "UPLOAD_WINDOW_ROWS", 4), \
+                mock.patch.object(views, "_ollama_embed_batch", side_effect=ValueError("bad model")) as embed:
+            body = self.upload_json(rows)
+        # The 30th error lands in window 8; nothing after it is embedded
+        self.assertEqual((body["success"], body["failed"]), (0, 32))
+        self.assertEqual(len(body["errors"]), 31)
+        self.assertEqual(body["errors"][-1]["error"], "Too many errors; truncated.")
+        self.assertEqual(embed.call_count, 8)
+
+    def test_parse_errors_stop_the_upload(self):
+        body = self.upload_json([{"id": 1, "prompt": "a"}] + ["not json"] * 50 + [{"id": 2, "prompt": "b"}])
+        self.assertEqual((body["success"], body["failed"]), (1, 30))
+        self.assertEqual([ids for _c, ids, _w in self.upserts], [["1"]])
+
+
+class UploadVersionTests(UploadTestCase):
+    rows = [{"id": i, "prompt": f"row {i}"} for i in range(1, 11)]
+
+    def test_bumped_after_upload(self):
+        v = views._collection_version
+        self.upload_json(self.rows)
+        self.assertEqual(views._collection_version, v + 1)
+
+    def test_not_bumped_when_nothing_was_written(self):
+        v = views._collection_version
+        self.upload_json(["{}"])
+        self.assertEqual(views._collection_version, v)
+
+    def test_bumped_when_progress_client_disconnects(self):
+        v = views._collection_version
+        with mock.patch.object(views, "UPLOAD_WINDOW_ROWS", 4):
+            r = self.upload(self.rows, progress="1")
+            first = next(iter(r.streaming_content))
+            r.close()  # the client went away after the first window
+        self.assertEqual(json.loads(first), {"line": 4, "success": 4, "failed": 0})
+        self.assertEqual(views._collection_version, v + 1)
+        self.assertEqual(len(self.upserts), 1)
+
+
+class _FakeStreamResponse:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        return iter(self.chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+
+class NifiActorRecordsTests(SimpleTestCase):
+    ACTORS = [{"EMPLOYEEID": "1", "BASICSALARY": 10.5}, {"EMPLOYEEID": "2", "NAME": "x"}, {}]
+
+    def records(self, chunks):
+        r = _FakeStreamResponse(chunks)
+        out = list(views._nifi_actor_records(r))
+        self.assertTrue(r.closed)
+        return out
+
+    def split(self, data, size=7):
+        return [b"", b"  \n"] + [data[i:i + size] for i in range(0, len(data), size)]
+
+    def assertBothParsers(self, chunks, expected):
+        self.assertEqual(self.records(chunks), expected)
+        with mock.patch.object(views, "ijson", None):
+            self.assertEqual(self.records(chunks), expected)
+
+    def test_array_split_across_chunks(self):
+        self.assertBothParsers(self.split(json.dumps(self.ACTORS).encode()), self.ACTORS)
+
+    def test_single_object(self):
+        self.assertBothParsers(self.split(b'{"EMPLOYEEID": "1"}'), [{"EMPLOYEEID": "1"}])
+
+    def test_scalar_body(self):
+        self.assertBothParsers([b"42"], [])
+
+    def test_empty_array(self):
+        self.assertBothParsers([b"[]"], [])
+
+    def test_invalid_body_raises(self):
+        with self.assertRaises(ValueError):
+            self.records([b"<html>"])
+
+
+class NdjsonStreamTests(SimpleTestCase):
+    def read(self, r):
+        self.assertEqual(r["Content-Type"], "application/x-ndjson; charset=utf-8")
+        return [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+
+    def test_deltas_then_tail(self):
+        done = []
+        r = views._ndjson_stream(iter(["a", "b "]), tail={"sources": []}, on_done=done.append)
+        self.assertEqual(self.read(r), [{"delta": "a"}, {"delta": "b "}, {"sources": []}])
+        self.assertEqual(done, ["ab"])
+
+    def test_failure_mid_stream(self):
+        def deltas():
+            yield "a"
+            raise requests.exceptions.ReadTimeout("slow")
+
+        done = []
+        r = views._ndjson_stream(deltas(), tail={"sources": []}, on_done=done.append)
+        self.assertEqual(self.read(r), [{"delta": "a"}, {"error": "Generation failed: slow"}])
+        self.assertEqual(done, [])
+
+
+class AskStreamTests(SimpleTestCase):
+    STATS = {
+        "employee_count": 2, "total_salary": 30.0, "avg_salary": 15.0,
+        "min_salary": 10.0, "max_salary": 20.0,
+        "max_salary_employee": {"EMPLOYEENAME": "B", "EMPLOYEEID": "2"},
+    }
+    HITS = [{"id": "p1", "score": 0.9, "payload": {"prompt": "EMPLOYEEID: 2 | BASICSALARY: 20"}}]
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(views, "_cached_salary_stats", side_effect=lambda: dict(self.STATS)),
+            mock.patch.object(views, "_rag_hits", return_value=self.HITS),
+            mock.patch.object(views, "_cached_query_embedding", return_value=[0.1, 0.2]),
+            mock.patch.object(views, "_cached_qdrant_query", return_value=self.HITS),
+            mock.patch.object(views, "_ollama_generate_stream", side_effect=lambda prompt: iter(["It ", "is B."])),
+            mock.patch.object(views, "_ollama_generate", return_value="It is B."),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def ask(self, **body):
+        r = views.api_ask(RequestFactory().post("/api/ask", json.dumps(body), content_type="application/json"))
+        self.assertEqual(r.status_code, 200)
+        if r.streaming:
+            return [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+        return json.loads(r.content)
+
+    def test_aggregation_streamed(self):
+        lines = self.ask(question="total salary of employees", stream=True)
+        self.assertEqual(lines[0], {"delta": "Total basic salary (ALL employees) = 30.0"})
+        self.assertEqual(lines[1]["sources"], [])
+        self.assertEqual(lines[1]["math"]["math_op"], "total_salary")
+        self.assertEqual(len(lines), 2)
+
+    def test_aggregation_with_explain_streamed(self):
+        question = "max salary of employees"
+        lines = self.ask(question=question, stream=True, explain=True)
+        plain = self.ask(question=question, explain=True)
+        self.assertEqual("".join(line.get("delta", "") for line in lines), plain["answer"])
+        self.assertEqual(lines[0]["delta"], "Max basic salary = 20.0 (Employee: B | ID: 2)\n\nExplanation/examples (Top-6):\n")
+        self.assertEqual(lines[-1], {"sources": plain["sources"], "math": plain["math"]})
+        self.assertEqual(lines[-1]["math"]["auto_flow"], "FULL_SCAN_MATH_THEN_RAG")
+
+    def test_rag_streamed(self):
+        lines = self.ask(question="Who is B?", stream=True)
+        self.assertEqual(lines, [
+            {"delta": "It "},
+            {"delta": "is B."},
+            {"sources": [{"id": "p1", "score": 0.9}], "auto_flow": "RAG_ONLY"},
+        ])
+
+
+class SalaryStatsCacheTests(SimpleTestCase):
+    POINTS = [
+        {"id": 1, "payload": {"EMPLOYEEID": "1", "BASICSALARY": 10}},
+        {"id": 2, "payload": {"EMPLOYEEID": "2", "BASICSALARY": 20}},
+    ]
+
+    def setUp(self):
+        self.count = 2
+        self.scan = mock.patch.object(views, "_qdrant_iter_points", side_effect=lambda **kw: iter(self.POINTS)).start()
+        mock.patch.object(views, "_cached_points_count", side_effect=lambda: self.count).start()
+        mock.patch.object(views, "_STATS_CACHE", views._TTLCache(16, 60)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_hit_skips_the_scan_and_says_so(self):
+        first = views._cached_salary_stats()
+        second = views._cached_salary_stats()
+        self.assertEqual(self.scan.call_count, 1)
+        self.assertFalse(first["cached"])
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["total_salary"], 30.0)
+        self.assertEqual(second["collection_points_count"], 2)
+        self.assertGreaterEqual(second["stats_age_seconds"], 0)
+
+    def test_callers_get_their_own_dict(self):
+        views._cached_salary_stats()["math_op"] = "x"
+        self.assertNotIn("math_op", views._cached_salary_stats())
+
+    def test_version_bump_rescans(self):
+        views._cached_salary_stats()
+        with mock.patch.object(views, "_answer_cache_clear"):
+            views._bump_collection_version()
+        self.assertFalse(views._cached_salary_stats()["cached"])
+        self.assertEqual(self.scan.call_count, 2)
+
+    def test_points_count_change_rescans(self):
+        views._cached_salary_stats()
+        self.count = 3
+        self.assertFalse(views._cached_salary_stats()["cached"])
+        self.assertEqual(self.scan.call_count, 2)
+
+    def test_expired_entry_rescans(self):
+        with mock.patch.object(views, "_STATS_CACHE", views._TTLCache(16, -1)):
+            views._cached_salary_stats()
+            self.assertFalse(views._cached_salary_stats()["cached"])
+        self.assertEqual(self.scan.call_count, 2)
+
+    def test_api_math_reports_cache_state(self):
+        def math():
+            r = views.api_math(RequestFactory().post("/api/math", '{"op": "total_salary"}', content_type="application/json"))
+            return json.loads(r.content)
+
+        self.assertFalse(math()["meta"]["cached"])
+        body = math()
+        self.assertEqual(body["total_salary"], 30.0)
+        self.assertTrue(body["meta"]["cached"])
+        self.assertIn("stats_age_seconds", body["meta"])
+
+
+class SessionRetryTests(SimpleTestCase):
+    """Status retries against a local server that always answers 503."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.hits = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                cls.hits.append(self.path)
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.hits.clear()
+
+    def test_generation_is_sent_once(self):
+        with mock.patch.object(views, "OLLAMA_URL", self.url), self.assertRaises(requests.exceptions.HTTPError):
+            views._ollama_generate("hi")
+        self.assertEqual(self.hits, ["/api/generate"])
+
+    def test_embed_is_retried(self):
+        with mock.patch.object(views, "OLLAMA_URL", self.url), self.assertRaises(requests.exceptions.HTTPError):
+            views._ollama_embed_batch("m", ["a"])
+        self.assertEqual(self.hits, ["/api/embed"] * 4)
@@ -8,15 +8,59 @@ import uuid
 
 import re
 
+import time
+
+import hashlib
+
+import queue
+
+import threading
+
+from array import array
+
+from collections import OrderedDict
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from functools import lru_cache
+
+from itertools import chain
+
+
+
 import requests
 
+from requests.adapters import HTTPAdapter
+
+from urllib3.util.retry import Retry
+
+
+
+try:
+
+    import orjson  # optional: faster JSON for the JSONL paths
+
+except ImportError:
+
+    orjson = None
+
+
+
+try:
+
+    import ijson  # optional: incremental parsing of the NiFi actors export
+
+except ImportError:
+
+    ijson = None
+
 
 
 from django.conf import settings
 
 from django.contrib.admin.views.decorators import staff_member_required
 
-from django.http import JsonResponse, StreamingHttpResponse, HttpResponseServerError
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseServerError
 
 from django.shortcuts import render, redirect
 
@@ -58,7 +102,19 @@ QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "dw_text").strip()
 
 
 
-# Timeouts
+# HNSW search breadth for RAG top-k queries
+
+QDRANT_HNSW_EF = int(os.getenv("QDRANT_HNSW_EF", "64"))
+
+# Quantized collections: fetch limit*oversampling candidates, rescore with original vectors
+
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", "2.0"))
+
+
+
+# Timeouts (read). CONNECT_TIMEOUT bounds the TCP connect separately so an
+
+# unreachable upstream fails fast instead of holding a worker for the read timeout.
 
 EMBED_TIMEOUT = int(os.getenv("EMBED_TIMEOUT", "220"))
 
@@ -66,285 +122,317 @@ QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", "90"))
 
 GEN_TIMEOUT = int(os.getenv("GEN_TIMEOUT", "900"))
 
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "5"))
 
 
-# JSONL prompt size
 
-MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "6000"))
+# HTTP connection pools (per upstream host)
 
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "16"))
 
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "64"))
 
-# ---------------------------------------------------------
+# Worker threads for overlapping independent upstream calls inside one request
 
-# Pages
+IO_POOL_WORKERS = int(os.getenv("IO_POOL_WORKERS", "4"))
 
-# ---------------------------------------------------------
 
-def index(request):
 
-    return render(request, "chat/index.html")
+# api_ask caches (question embeddings, search hits)
 
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
 
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "300"))
 
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
 
+# Seconds a collection's info / points_count may be served from memory
 
-def upload_page(request):
+QDRANT_INFO_TTL = float(os.getenv("QDRANT_INFO_TTL", "5"))
 
-    return render(request, "chat/upload.html")
+# Full-scan salary stats: reused while the collection's version and points_count
 
+# are unchanged, for at most this many seconds. Bounds how long a write made outside
 
+# this app that keeps points_count (an in-place payload edit) goes unnoticed.
 
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
 
 
-# ---------------------------------------------------------
 
-# Ollama helpers
+# api_ask semantic answer cache: Qdrant collection of past question vectors.
 
-# ---------------------------------------------------------
+# Off unless set (e.g. "rag_answer_cache"): near-identical questions about two
 
-def _ollama_embeddings_with_model(model: str, text: str):
+# different employees can clear the threshold and get each other's answer.
 
-    r = requests.post(
+# A hit needs cosine >= threshold and an entry younger than TTL.
 
-        f"{OLLAMA_URL}/api/embeddings",
+ANSWER_CACHE_COLLECTION = os.getenv("ANSWER_CACHE_COLLECTION", "").strip()
 
-        json={"model": model, "prompt": text},
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
 
-        timeout=EMBED_TIMEOUT,
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
 
-    )
 
-    r.raise_for_status()
 
-    data = r.json()
+# api_chat: max characters kept per history message, and for all history together
 
-    if "embedding" not in data:
+# (newest messages win the budget)
 
-        raise RuntimeError(f"Ollama embeddings response missing 'embedding': {data}")
+CHAT_HISTORY_MAX_CHARS = int(os.getenv("CHAT_HISTORY_MAX_CHARS", "2048"))
 
-    return data["embedding"]
+CHAT_HISTORY_BUDGET_CHARS = int(os.getenv("CHAT_HISTORY_BUDGET_CHARS", "6000"))
 
 
 
+# api_ask: max characters of retrieved context put into a prompt
 
+MAX_RAG_CONTEXT_CHARS = int(os.getenv("MAX_RAG_CONTEXT_CHARS", "8000"))
 
-def _ollama_embeddings(text: str):
 
-    return _ollama_embeddings_with_model(EMBED_MODEL, text)
 
+# JSONL prompt size
 
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "6000"))
 
 
 
-def _ollama_generate(prompt: str):
+# JSONL export: bytes per streamed response chunk
 
-    r = requests.post(
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
 
-        f"{OLLAMA_URL}/api/chat",
 
-        json={
 
-            "model": GEN_MODEL,
+# JSONL upload: texts per Ollama /api/embed request. Adaptive per upload: starts at
 
-            "messages": [
+# EMBED_BATCH_INIT, doubles on sustained success, halves on timeouts / 5xx.
 
-                {"role": "system", "content": "You are a helpful assistant."},
+EMBED_BATCH_INIT = int(os.getenv("EMBED_BATCH_INIT", os.getenv("OLLAMA_EMBED_BATCH", "32")))
 
-                {"role": "user", "content": prompt},
+EMBED_BATCH_MIN = max(1, int(os.getenv("EMBED_BATCH_MIN", "1")))
 
-            ],
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "128"))
 
-            "stream": False,
 
-            "options": {
 
-                "temperature": 0.2,
+# JSONL upload: /api/embed requests in flight (bounded by the connection pool)
 
-                "top_p": 0.9,
+EMBED_CONCURRENCY = max(
 
-                "num_predict": 280,
+    1, min(int(os.getenv("EMBED_CONCURRENCY", os.getenv("UPLOAD_WORKERS", "4"))), HTTP_POOL_MAXSIZE)
 
-            },
+)
 
-        },
 
-        timeout=GEN_TIMEOUT,
 
-    )
+# JSONL upload: size cap, and bytes read up front to check the first record
 
-    r.raise_for_status()
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", "500000000"))
 
-    data = r.json()
+UPLOAD_SNIFF_BYTES = 65536
 
-    return (data.get("message", {}).get("content") or "").strip()
+# Stripped from the start of an upload, so a BOM doesn't cost its first line
 
+_UTF8_BOM = b"\xef\xbb\xbf"
 
 
 
+# JSONL upload: rows parsed, embedded and upserted per window
+
+UPLOAD_WINDOW_ROWS = max(1, int(os.getenv("UPLOAD_WINDOW_ROWS", "1024")))
+
+
+
+# JSONL upload: turn HNSW indexing off (indexing_threshold=0) while a multi-window
+
+# upload runs and restore the collection's previous threshold afterwards
+
+UPLOAD_DEFER_INDEXING = os.getenv("UPLOAD_DEFER_INDEXING", "1") == "1"
+
+
+
+# JSONL upload: decimals kept per vector component on the wire (0 = full precision).
+
+# 5 decimals is finer than float16 storage for the magnitudes embeddings produce.
+
+VECTOR_WIRE_DECIMALS = int(os.getenv("VECTOR_WIRE_DECIMALS", "5"))
+
+
+
+# Full-scan math: points per scroll page. The projection still includes "prompt"
+
+# (salary fallback), which is what this app's own exports carry: up to
+
+# MAX_PROMPT_CHARS (~6 KB) per point, so ~1.5 MB per 250-point page. Up to four
+
+# pages are held at once (two prefetched, one being read, one waiting to queue).
+
+QDRANT_SCROLL_BATCH = max(1, int(os.getenv("QDRANT_SCROLL_BATCH", "250")))
+
+
+
+# JSONL upload: points per Qdrant upsert request
+
+QDRANT_UPSERT_BATCH = max(1, int(os.getenv("QDRANT_UPSERT_BATCH", "128")))
 
-# ---------------------------------------------------------
 
-# Qdrant helpers
 
 # ---------------------------------------------------------
 
-def _qdrant_search(vector, limit=6):
+# HTTP sessions (keep-alive connections reused across requests)
 
-    """Vector similarity search (Top-K)."""
+# ---------------------------------------------------------
 
-    r = requests.post(
+def _make_session(retry_status=True):
 
-        f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}/points/search",
+    """
 
-        json={
+    Pooled session. retry_status=False: never resend a request the upstream
 
-            "vector": vector,
+    answered, even with 502/503/504 (use it where a resend repeats real work).
 
-            "limit": int(limit),
+    """
 
-            "with_payload": True,
+    s = requests.Session()
 
-            "with_vector": False,
+    adapter = HTTPAdapter(
 
-        },
+        pool_connections=HTTP_POOL_CONNECTIONS,
 
-        timeout=QDRANT_TIMEOUT,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
 
-    )
+        max_retries=Retry(
 
-    r.raise_for_status()
+            total=3,
 
-    return r.json().get("result", []) or []
+            # One connect retry: a dead upstream fails within ~2 x CONNECT_TIMEOUT, not 4 x
 
+            connect=1,
 
+            # read=False (not 0): a request that timed out reading is not resent, and
 
+            # surfaces as ReadTimeout, which _is_overload treats as back-pressure
 
+            read=False,
 
-def _qdrant_upsert(collection: str, pid: str, vector, payload: dict):
+            backoff_factor=0.3,
 
-    body = {"points": [{"id": pid, "vector": vector, "payload": payload}]}
+            status_forcelist=(502, 503, 504) if retry_status else (),
 
-    r = requests.put(
+            respect_retry_after_header=retry_status,  # else a 503 + Retry-After is resent anyway
 
-        f"{QDRANT_URL}/collections/{collection}/points?wait=true",
+            # POST/PUT too: embed and Qdrant POSTs are reads and upserts are id-keyed
 
-        json=body,
+            allowed_methods=None,
 
-        timeout=EMBED_TIMEOUT,
+            raise_on_status=False,  # hand back the last response; callers raise_for_status()
 
-    )
+        ),
 
-    r.raise_for_status()
+    )
 
+    s.mount("http://", adapter)
 
+    s.mount("https://", adapter)
 
+    return s
 
 
-def _qdrant_scroll_all(batch_size=200):
 
-    """
 
-    Scroll ALL points from the collection.
 
-    No max limit. Stops only when Qdrant says there are no more points.
+_OLLAMA_SESSION = _make_session()
 
-    """
+# /api/generate: a 503 (Ollama queue full) or a proxy's 504 must not run the
 
-    all_points = []
+# same generation again, piling more load onto an already busy upstream
 
-    offset = None
+_OLLAMA_GEN_SESSION = _make_session(retry_status=False)
 
+_QDRANT_SESSION = _make_session()
 
+_NIFI_SESSION = _make_session()
 
-    while True:
 
-        body = {
 
-            "limit": int(batch_size),
+# Shared by views that overlap independent upstream calls (api_ask aggregation)
 
-            "with_payload": True,
+_IO_POOL = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix="upstream-io")
 
-            "with_vectors": False,
 
-        }
 
-        if offset is not None:
 
-            body["offset"] = offset
 
+# ---------------------------------------------------------
 
+# JSON helpers (orjson when installed, stdlib otherwise)
 
-        r = requests.post(
+# ---------------------------------------------------------
 
-            f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}/points/scroll",
+def _json_loads(data):
 
-            json=body,
+    """Parse JSON from bytes or str."""
 
-            timeout=QDRANT_TIMEOUT,
+    if orjson is not None:
 
-        )
+        return orjson.loads(data)
 
-        r.raise_for_status()
+    return json.loads(data)
 
 
 
-        result = r.json().get("result", {}) or {}
 
-        points = result.get("points", []) or []
 
-        all_points.extend(points)
+def _json_dumps_bytes(obj) -> bytes:
 
+    """Serialize to UTF-8 JSON bytes, keeping non-ASCII characters as-is."""
 
+    if orjson is not None:
 
-        offset = result.get("next_page_offset")
+        return orjson.dumps(obj)
 
-        if not offset or not points:
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
-            break
 
 
 
-    return all_points
 
+# For request bodies pre-serialized with _json_dumps_bytes (data=...)
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 
-def _qdrant_points_count():
 
-    r = requests.get(f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}", timeout=30)
 
-    r.raise_for_status()
+def _json_response(data, status=200):
 
-    return r.json().get("result", {}).get("points_count")
+    """JsonResponse equivalent serialized with _json_dumps_bytes."""
 
+    return HttpResponse(_json_dumps_bytes(data), status=status, content_type="application/json")
 
 
 
 
-def _dedupe_hits(hits):
 
-    # Dedupe by prefix of payload.prompt (helps when same rows re-uploaded)
+# ---------------------------------------------------------
 
-    seen = set()
+# Pages
 
-    out = []
+# ---------------------------------------------------------
 
-    for h in hits:
+def index(request):
 
-        p = h.get("payload") or {}
+    return render(request, "chat/index.html")
 
-        txt = (p.get("prompt") or "").strip()
 
-        key = txt[:220]
 
-        if key and key not in seen:
 
-            seen.add(key)
 
-            out.append(h)
+def upload_page(request):
 
-    return out
+    return render(request, "chat/upload.html")
 
 
 
@@ -352,259 +440,273 @@ def _dedupe_hits(hits):
 
 # ---------------------------------------------------------
 
-# Math detection + extraction helpers
+# Ollama helpers
 
 # ---------------------------------------------------------
 
-_salary_re = re.compile(r"\bBASICSALARY\s*:\s*([0-9]+(?:\.[0-9]+)?)\b", re.IGNORECASE)
+def _ollama_embeddings_legacy(model: str, text: str):
 
-_name_re = re.compile(r"\bEMPLOYEENAME\s*:\s*([^|]+)", re.IGNORECASE)
+    """Single text via the deprecated /api/embeddings endpoint (older Ollama builds)."""
 
+    r = _OLLAMA_SESSION.post(
 
+        f"{OLLAMA_URL}/api/embeddings",
 
-def _looks_like_global_aggregation(question: str) -> bool:
+        json={"model": model, "prompt": text},
 
-    q = (question or "").lower()
+        timeout=(CONNECT_TIMEOUT, EMBED_TIMEOUT),
 
-    agg_keywords = [
+    )
 
-        "total", "sum", "average", "avg", "mean", "count",
+    r.raise_for_status()
 
-        "maximum", "max", "highest", "minimum", "min", "lowest",
+    data = _json_loads(r.content)
 
-        "median", "top ", "top-"
+    if "embedding" not in data:
 
-    ]
+        raise RuntimeError(f"Ollama embeddings response missing 'embedding': {data}")
 
-    target_keywords = ["employee", "employees", "salary", "basic", "basicsalary", "pay", "wage"]
+    return data["embedding"]
 
-    return any(a in q for a in agg_keywords) and any(t in q for t in target_keywords)
 
 
 
 
+def _ollama_embed_batch(model: str, texts):
 
-def _pick_math_op(question: str) -> str:
+    """Embed many texts in one request via /api/embed (falls back to one-by-one)."""
 
-    q = (question or "").lower()
+    r = _OLLAMA_SESSION.post(
 
-    if ("max" in q or "maximum" in q or "highest" in q) and ("salary" in q or "basic" in q):
+        f"{OLLAMA_URL}/api/embed",
 
-        return "max_salary"
+        json={"model": model, "input": list(texts)},
 
-    if ("min" in q or "minimum" in q or "lowest" in q) and ("salary" in q or "basic" in q):
+        timeout=(CONNECT_TIMEOUT, EMBED_TIMEOUT),
 
-        return "min_salary"
+    )
 
-    if ("total" in q or "sum" in q) and ("salary" in q or "basic" in q):
+    if r.status_code != 404:
 
-        return "total_salary"
+        r.raise_for_status()
 
-    if ("average" in q or "avg" in q or "mean" in q) and ("salary" in q or "basic" in q):
+        embeddings = _json_loads(r.content).get("embeddings")
 
-        return "avg_salary"
+        if isinstance(embeddings, list) and len(embeddings) == len(texts):
 
-    if "count" in q and ("employee" in q or "employees" in q):
+            return embeddings
 
-        return "count_employees"
 
-    return "salary_stats"
 
+    # Older Ollama builds: no /api/embed (404) or unexpected response shape
 
+    return [_ollama_embeddings_legacy(model, t) for t in texts]
 
 
 
-def _employee_key(payload: dict):
 
-    for key in ("EMPLOYEEID", "employeeid", "employee_id", "EmployeeId"):
 
-        v = payload.get(key)
+def _ollama_embeddings_with_model(model: str, text: str):
 
-        if v is not None and str(v).strip() != "":
+    return _ollama_embed_batch(model, [text])[0]
 
-            return str(v).strip()
 
-    return None
 
 
 
+def _ollama_embeddings(text: str):
 
+    return _ollama_embeddings_with_model(EMBED_MODEL, text)
 
-def _extract_salary(payload: dict):
 
-    # Prefer structured field
 
-    for key in ("BASICSALARY", "basicSalary", "SALARY", "salary"):
 
-        if key in payload and str(payload.get(key)).strip() != "":
 
-            try:
+# Callers pass the whole conversation as one prompt string, so /api/generate
 
-                return float(str(payload.get(key)).replace(",", "").strip())
+# (prompt + system) is enough; /api/chat would only re-template a 1-message list.
 
-            except Exception:
+_GEN_SYSTEM = "You are a helpful assistant."
 
-                pass
+_GEN_OPTIONS = {
 
+    "temperature": 0.2,
 
+    "top_p": 0.9,
 
-    # Fallback parse from prompt
+    "num_predict": 280,
 
-    txt = payload.get("prompt") or ""
+}
 
-    m = _salary_re.search(txt)
 
-    if m:
 
-        try:
 
-            return float(m.group(1))
 
-        except Exception:
+# Everything but the prompt is fixed, so the request body is serialized once per
 
-            return None
+# stream mode as an open JSON object; each call only encodes the prompt string.
 
-    return None
+_GEN_BODY_PREFIX = {
 
+    stream: _json_dumps_bytes(
 
+        {"model": GEN_MODEL, "system": _GEN_SYSTEM, "stream": stream, "options": _GEN_OPTIONS}
 
+    )[:-1] + b',"prompt":'
 
+    for stream in (False, True)
 
-def _extract_name(payload: dict):
+}
 
-    for key in ("EMPLOYEENAME", "employee_name", "name", "EmployeeName"):
 
-        v = payload.get(key)
 
-        if v is not None and str(v).strip() != "":
 
-            return str(v).strip()
 
+def _ollama_gen_body(prompt: str, stream: bool) -> bytes:
 
+    return _GEN_BODY_PREFIX[stream] + _json_dumps_bytes(prompt) + b"}"
 
-    txt = payload.get("prompt") or ""
 
-    m = _name_re.search(txt)
 
-    if m:
 
-        return (m.group(1) or "").strip()
 
-    return ""
+def _ollama_generate(prompt: str):
 
+    r = _OLLAMA_GEN_SESSION.post(
 
+        f"{OLLAMA_URL}/api/generate",
 
+        data=_ollama_gen_body(prompt, stream=False),
 
+        headers=_JSON_HEADERS,
 
-def _compute_salary_stats_from_points(points):
+        timeout=(CONNECT_TIMEOUT, GEN_TIMEOUT),
 
-    """
+    )
 
-    Computes exact statistics from ALL points (full scroll).
+    r.raise_for_status()
 
-    Dedupe by EMPLOYEEID if present to avoid duplicates.
+    data = _json_loads(r.content)
 
-    """
+    return (data.get("response") or "").strip()
 
-    seen_emp = set()
 
 
 
-    salary_sum = 0.0
 
-    salary_values_found = 0
+def _ollama_generate_stream(prompt: str):
 
+    """
 
+    Like _ollama_generate, but returns an iterator of content deltas as Ollama
 
-    min_salary = None
+    produces them. The request is sent (and HTTP errors raised) before this
 
-    max_salary = None
+    returns, so callers can still answer with a normal error response.
 
-    min_emp = None
+    """
 
-    max_emp = None
+    r = _OLLAMA_GEN_SESSION.post(
 
+        f"{OLLAMA_URL}/api/generate",
 
+        data=_ollama_gen_body(prompt, stream=True),
 
-    for p in points:
+        headers=_JSON_HEADERS,
 
-        payload = p.get("payload") or {}
+        timeout=(CONNECT_TIMEOUT, GEN_TIMEOUT),
 
+        stream=True,
 
+    )
 
-        emp_id = _employee_key(payload)
+    try:
 
-        if emp_id:
+        r.raise_for_status()
 
-            if emp_id in seen_emp:
+    except requests.exceptions.HTTPError:
 
-                continue
+        r.close()
 
-            seen_emp.add(emp_id)
+        raise
 
 
 
-        sal = _extract_salary(payload)
+    def deltas():
 
-        if sal is None:
+        with r:
 
-            continue
+            for line in r.iter_lines():
 
+                if not line:
 
+                    continue
 
-        salary_sum += sal
+                chunk = _json_loads(line)
 
-        salary_values_found += 1
+                if chunk.get("error"):
+
+                    raise RuntimeError(chunk["error"])
 
+                delta = chunk.get("response") or ""
 
+                if delta:
 
-        emp_name = _extract_name(payload)
+                    yield delta
 
+                if chunk.get("done"):
 
+                    break
 
-        if min_salary is None or sal < min_salary:
 
-            min_salary = sal
 
-            min_emp = {"EMPLOYEEID": emp_id, "EMPLOYEENAME": emp_name, "BASICSALARY": sal}
+    return deltas()
 
 
 
-        if max_salary is None or sal > max_salary:
 
-            max_salary = sal
 
-            max_emp = {"EMPLOYEEID": emp_id, "EMPLOYEENAME": emp_name, "BASICSALARY": sal}
+def _ndjson_stream(deltas, tail=None, on_done=None):
 
+    """
 
+    NDJSON response for a streamed answer: one {"delta": ...} line per chunk,
 
-    employee_count = len(seen_emp) if seen_emp else salary_values_found
+    then `tail` (if any) as the last line. on_done(full_answer) runs after a
 
-    avg_salary = (salary_sum / employee_count) if employee_count else 0.0
+    complete generation; a mid-stream failure ends with an {"error": ...} line.
 
+    """
 
+    def lines():
 
-    return {
+        got = []
 
-        "employee_count": employee_count,
+        try:
 
-        "salary_values_found": salary_values_found,
+            for d in deltas:
 
-        "total_salary": salary_sum,
+                got.append(d)
 
-        "avg_salary": avg_salary,
+                yield _json_dumps_bytes({"delta": d}) + b"\n"
 
-        "min_salary": min_salary,
+        except Exception as e:
 
-        "max_salary": max_salary,
+            yield _json_dumps_bytes({"error": f"Generation failed: {str(e)}"}) + b"\n"
 
-        "min_salary_employee": min_emp,
+            return
 
-        "max_salary_employee": max_emp,
+        if on_done is not None:
+
+            on_done("".join(got).strip())
+
+        if tail is not None:
+
+            yield _json_dumps_bytes(tail) + b"\n"
 
-        "dedup_by_employeeid": bool(seen_emp),
 
-    }
+
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson; charset=utf-8")
 
 
 
@@ -612,665 +714,2539 @@ def _compute_salary_stats_from_points(points):
 
 # ---------------------------------------------------------
 
-# API: LLM-only chat (no RAG)
+# Qdrant helpers
 
 # ---------------------------------------------------------
 
-@csrf_exempt
+# Ignored by Qdrant for collections without quantization
 
-def api_chat(request):
+_QUERY_PARAMS = {
 
-    if request.method != "POST":
+    "hnsw_ef": QDRANT_HNSW_EF,
 
-        return JsonResponse({"error": "POST required"}, status=405)
+    "exact": False,
 
+    "quantization": {"rescore": True, "oversampling": QDRANT_OVERSAMPLING},
 
+}
 
-    try:
 
-        payload = json.loads(request.body.decode("utf-8"))
 
-        user_message = (payload.get("message") or "").strip()
 
-        history = payload.get("history") or []
+
+def _qdrant_query(vector, limit=6):
+
+    """Vector similarity search (Top-K) via the Query API, HNSW (not exact)."""
+
+    r = _QDRANT_SESSION.post(
+
+        f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}/points/query",
+
+        json={
+
+            "query": vector,
+
+            "limit": int(limit),
+
+            "with_payload": {"include": ["prompt"]},
+
+            "with_vector": False,
+
+            "params": _QUERY_PARAMS,
+
+        },
+
+        timeout=(CONNECT_TIMEOUT, QDRANT_TIMEOUT),
+
+    )
+
+    if r.status_code == 404:
+
+        # Qdrant < 1.10 has no Query API
+
+        return _qdrant_search(vector, limit=limit)
+
+    r.raise_for_status()
+
+    return (_json_loads(r.content).get("result") or {}).get("points", []) or []
+
+
+
+
+
+def _qdrant_search(vector, limit=6):
+
+    """Vector similarity search (Top-K), legacy search endpoint."""
+
+    r = _QDRANT_SESSION.post(
+
+        f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}/points/search",
+
+        json={
+
+            "vector": vector,
+
+            "limit": int(limit),
+
+            "with_payload": {"include": ["prompt"]},
+
+            "with_vector": False,
+
+            "params": _QUERY_PARAMS,
+
+        },
+
+        timeout=(CONNECT_TIMEOUT, QDRANT_TIMEOUT),
+
+    )
+
+    r.raise_for_status()
+
+    return _json_loads(r.content).get("result", []) or []
+
+
+
+
+
+def _qdrant_upsert_batch(collection: str, points, wait=False):
+
+    """Upsert many points in one request. wait=False lets Qdrant apply them asynchronously."""
+
+    r = _QDRANT_SESSION.put(
+
+        f"{QDRANT_URL}/collections/{collection}/points?wait={'true' if wait else 'false'}",
+
+        data=_json_dumps_bytes({"points": list(points)}),
+
+        headers=_JSON_HEADERS,
+
+        timeout=(CONNECT_TIMEOUT, QDRANT_TIMEOUT),
+
+    )
+
+    r.raise_for_status()
+
+
+
+
+
+def _qdrant_indexing_threshold(collection: str):
+
+    """Current optimizer indexing_threshold of a collection, or None if unknown."""
+
+    try:
+
+        r = _QDRANT_SESSION.get(f"{QDRANT_URL}/collections/{collection}", timeout=(CONNECT_TIMEOUT, 30))
+
+        r.raise_for_status()
+
+        cfg = (r.json().get("result") or {}).get("config") or {}
+
+        return (cfg.get("optimizer_config") or {}).get("indexing_threshold")
+
+    except (requests.exceptions.RequestException, ValueError):
+
+        return None
+
+
+
+
+
+def _qdrant_set_indexing_threshold(collection: str, value: int):
+
+    r = _QDRANT_SESSION.patch(
+
+        f"{QDRANT_URL}/collections/{collection}",
+
+        json={"optimizers_config": {"indexing_threshold": int(value)}},
+
+        timeout=(CONNECT_TIMEOUT, 30),
+
+    )
+
+    r.raise_for_status()
+
+
+
+
+
+def _qdrant_defer_indexing(collection: str):
+
+    """
+
+    Best-effort: set indexing_threshold=0 for a bulk load. Returns the previous
+
+    threshold to restore afterwards, or None if nothing was changed.
+
+    """
+
+    current = _qdrant_indexing_threshold(collection)
+
+    if not current:
+
+        return None
+
+    try:
+
+        _qdrant_set_indexing_threshold(collection, 0)
+
+    except requests.exceptions.RequestException:
+
+        return None
+
+    return current
+
+
+
+
+
+def _wire_vector(vec):
+
+    """Round vector components so upsert bodies carry ~8 instead of ~20 chars per float."""
+
+    if VECTOR_WIRE_DECIMALS <= 0:
+
+        return vec
+
+    return [round(x, VECTOR_WIRE_DECIMALS) for x in vec]
+
+
+
+
+
+def _qdrant_scroll_pages(batch_size=200, payload_fields=None):
+
+    """
+
+    Yield scroll pages (lists of points) until Qdrant says there are no more.
+
+    A background thread fetches page N+1 while the caller processes page N.
+
+    payload_fields: only return these payload keys (None = full payload).
+
+    """
+
+    pages = queue.Queue(maxsize=2)
+
+    stop = threading.Event()
+
+
+
+    def put(item):
+
+        while not stop.is_set():
+
+            try:
+
+                pages.put(item, timeout=0.5)
+
+                return
+
+            except queue.Full:
+
+                continue
+
+
+
+    def fetch():
+
+        offset = None
+
+        try:
+
+            while not stop.is_set():
+
+                body = {
+
+                    "limit": int(batch_size),
+
+                    "with_payload": {"include": list(payload_fields)} if payload_fields else True,
+
+                    "with_vectors": False,
+
+                }
+
+                if offset is not None:
+
+                    body["offset"] = offset
+
+
+
+                r = _QDRANT_SESSION.post(
+
+                    f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}/points/scroll",
+
+                    json=body,
+
+                    timeout=(CONNECT_TIMEOUT, QDRANT_TIMEOUT),
+
+                )
+
+                r.raise_for_status()
+
+
+
+                result = _json_loads(r.content).get("result", {}) or {}
+
+                points = result.get("points", []) or []
+
+                put(points)
+
+
+
+                offset = result.get("next_page_offset")
+
+                if not offset or not points:
+
+                    break
+
+        except Exception as e:
+
+            put(e)
+
+        finally:
+
+            put(None)
+
+
+
+    threading.Thread(target=fetch, daemon=True).start()
+
+    try:
+
+        while True:
+
+            item = pages.get()
+
+            if item is None:
+
+                return
+
+            if isinstance(item, Exception):
+
+                raise item
+
+            if item:
+
+                yield item
+
+    finally:
+
+        stop.set()
+
+
+
+
+
+def _qdrant_iter_points(max_points=None, batch_size=200, payload_fields=None):
+
+    """
+
+    Yield points from the collection one by one, page by page.
+
+    No max limit by default. Stops when Qdrant says there are no more points.
+
+    """
+
+    n = 0
+
+    for points in _qdrant_scroll_pages(batch_size, payload_fields):
+
+        for p in points:
+
+            if max_points is not None and n >= max_points:
+
+                return
+
+            n += 1
+
+            yield p
+
+
+
+
+
+def _qdrant_points_count():
+
+    r = _QDRANT_SESSION.get(f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}", timeout=(CONNECT_TIMEOUT, 30))
+
+    r.raise_for_status()
+
+    return r.json().get("result", {}).get("points_count")
+
+
+
+
+
+def _dedupe_hits(hits):
+
+    # Dedupe by a 64-bit hash of the normalized payload.prompt prefix
+
+    # (helps when same rows re-uploaded). Keys only live for this call, so
+
+    # the builtin (per-process seeded) str hash is enough.
+
+    seen = set()
+
+    out = []
+
+    for h in hits:
+
+        p = h.get("payload") or {}
+
+        txt = (p.get("prompt") or "").strip()
+
+        if not txt:
+
+            continue
+
+        prefix = " ".join(txt[:220].lower().split())
+
+        key = hash(prefix)
+
+        if key not in seen:
+
+            seen.add(key)
+
+            out.append(h)
+
+    return out
+
+
+
+
+
+# ---------------------------------------------------------
+
+# Query caches (api_ask)
+
+# ---------------------------------------------------------
+
+class _TTLCache:
+
+    """Thread-safe LRU cache whose entries expire after ttl_seconds."""
+
+
+
+    def __init__(self, maxsize, ttl_seconds):
+
+        self.maxsize = maxsize
+
+        self.ttl_seconds = ttl_seconds
+
+        self._data = OrderedDict()
+
+        self._lock = threading.Lock()
+
+
+
+    def get(self, key):
+
+        with self._lock:
+
+            item = self._data.get(key)
+
+            if item is None:
+
+                return None
+
+            expires_at, value = item
+
+            if expires_at < time.monotonic():
+
+                del self._data[key]
+
+                return None
+
+            self._data.move_to_end(key)
+
+            return value
+
+
+
+    def set(self, key, value):
+
+        with self._lock:
+
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+
+                self._data.popitem(last=False)
+
+
+
+
+
+_EMBED_CACHE = _TTLCache(EMBED_CACHE_SIZE, QUERY_CACHE_TTL)
+
+_SEARCH_CACHE = _TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+_INFO_CACHE = _TTLCache(64, QDRANT_INFO_TTL)
+
+_STATS_CACHE = _TTLCache(16, STATS_CACHE_TTL)
+
+
+
+# Bumped whenever collection contents change; part of the search cache key.
+
+_collection_version = 0
+
+
+
+
+
+def _bump_collection_version():
+
+    global _collection_version
+
+    _collection_version += 1
+
+    _answer_cache_clear()
+
+
+
+
+
+def _cached_query_embedding(text: str):
+
+    norm = " ".join(text.lower().split())
+
+    if not norm:
+
+        return _ollama_embeddings(text)
+
+
+
+    key = (EMBED_MODEL, norm)
+
+    vec = _EMBED_CACHE.get(key)
+
+    if vec is None:
+
+        # Stored as a tuple so no caller can mutate the shared cached vector
+
+        vec = tuple(_ollama_embeddings(text))
+
+        _EMBED_CACHE.set(key, vec)
+
+    return list(vec)
+
+
+
+
+
+def _cached_qdrant_query(vector, limit=6):
+
+    vec_hash = hashlib.blake2b(array("f", vector).tobytes(), digest_size=16).hexdigest()
+
+    key = (QDRANT_COLLECTION, _collection_version, vec_hash, int(limit))
+
+    hits = _SEARCH_CACHE.get(key)
+
+    if hits is None:
+
+        hits = _qdrant_query(vector, limit=limit)
+
+        _SEARCH_CACHE.set(key, hits)
+
+    return hits
+
+
+
+
+
+def _cached_points_count():
+
+    key = ("points_count", QDRANT_COLLECTION, _collection_version)
+
+    count = _INFO_CACHE.get(key)
+
+    if count is None:
+
+        count = _qdrant_points_count()
+
+        _INFO_CACHE.set(key, count)
+
+    return count
+
+
+
+
+
+def _rag_context(hits):
+
+    """
+
+    CONTEXT text and sources for a RAG prompt. Hits arrive best-first, so once
+
+    MAX_RAG_CONTEXT_CHARS is reached the lower-scored remainder is dropped
+
+    (the first block is cut to fit rather than dropped).
+
+    """
+
+    ctx_blocks = []
+
+    sources = []
+
+    budget = MAX_RAG_CONTEXT_CHARS
+
+    for i, h in enumerate(hits, 1):
+
+        p = h.get("payload") or {}
+
+        txt = (p.get("prompt") or "").strip()
+
+        if not txt:
+
+            continue
+
+        block = f"[{i}] {txt}"
+
+        if len(block) > budget:
+
+            if ctx_blocks:
+
+                break
+
+            block = block[:budget]
+
+        budget -= len(block) + 2  # + the "\n\n" separator
+
+        ctx_blocks.append(block)
+
+        sources.append({"id": h.get("id"), "score": h.get("score")})
+
+
+
+    return "\n\n".join(ctx_blocks), sources
+
+
+
+
+
+def _rag_hits(question: str, limit=6):
+
+    """Deduped top-k hits for a question (cached embedding + cached query)."""
+
+    vec = _cached_query_embedding(question)
+
+    return _dedupe_hits(_cached_qdrant_query(vec, limit=limit))
+
+
+
+
+
+# ---------------------------------------------------------
+
+# Semantic answer cache (api_ask)
+
+# Best-effort: any Qdrant error is treated as a miss / ignored.
+
+# ---------------------------------------------------------
+
+def _answer_cache_filter(top_k=None):
+
+    must = [{"key": "collection", "match": {"value": QDRANT_COLLECTION}}]
+
+    if top_k is not None:
+
+        must.append({"key": "top_k", "match": {"value": int(top_k)}})
+
+        must.append({"key": "ts", "range": {"gt": time.time() - ANSWER_CACHE_TTL}})
+
+    return {"must": must}
+
+
+
+
+
+def _answer_cache_lookup(vector, top_k):
+
+    """Cached payload ({"answer", "sources"}) for a near-identical earlier question, or None."""
+
+    if not ANSWER_CACHE_COLLECTION:
+
+        return None
+
+    try:
+
+        r = _QDRANT_SESSION.post(
+
+            f"{QDRANT_URL}/collections/{ANSWER_CACHE_COLLECTION}/points/search",
+
+            json={
+
+                "vector": vector,
+
+                "limit": 1,
+
+                "with_payload": {"include": ["answer", "sources"]},
+
+                "score_threshold": ANSWER_CACHE_THRESHOLD,
+
+                "filter": _answer_cache_filter(top_k),
+
+            },
+
+            timeout=(CONNECT_TIMEOUT, QDRANT_TIMEOUT),
+
+        )
+
+        if r.status_code == 404:
+
+            return None  # cache collection not created yet
+
+        r.raise_for_status()
+
+        hits = _json_loads(r.content).get("result") or []
+
+    except requests.exceptions.RequestException:
+
+        return None
+
+    payload = (hits[0].get("payload") or {}) if hits else {}
+
+    return payload if payload.get("answer") else None
+
+
+
+
+
+def _answer_cache_store(vector, question: str, answer: str, sources, top_k):
+
+    if not ANSWER_CACHE_COLLECTION or not answer:
+
+        return
+
+    norm = " ".join(question.lower().split())
+
+    point = {
+
+        # Same question again overwrites its entry instead of piling up
+
+        "id": str(uuid.uuid5(uuid.NAMESPACE_DNS, f"answer:{QDRANT_COLLECTION}:{top_k}:{norm}")),
+
+        "vector": list(vector),
+
+        "payload": {
+
+            "collection": QDRANT_COLLECTION,
+
+            "top_k": int(top_k),
+
+            "question": question,
+
+            "answer": answer,
+
+            "sources": sources,
+
+            "ts": time.time(),
+
+        },
+
+    }
+
+    try:
+
+        try:
+
+            _qdrant_upsert_batch(ANSWER_CACHE_COLLECTION, [point])
+
+        except requests.exceptions.HTTPError as e:
+
+            if e.response is None or e.response.status_code != 404:
+
+                raise
+
+            r = _QDRANT_SESSION.put(
+
+                f"{QDRANT_URL}/collections/{ANSWER_CACHE_COLLECTION}",
+
+                json={"vectors": {"size": len(point["vector"]), "distance": "Cosine"}},
+
+                timeout=(CONNECT_TIMEOUT, 30),
+
+            )
+
+            r.raise_for_status()
+
+            _qdrant_upsert_batch(ANSWER_CACHE_COLLECTION, [point])
+
+    except requests.exceptions.RequestException:
+
+        pass
+
+
+
+
+
+def _answer_cache_clear():
+
+    """Drop cached answers for QDRANT_COLLECTION (its contents changed)."""
+
+    if not ANSWER_CACHE_COLLECTION:
+
+        return
+
+    try:
+
+        _QDRANT_SESSION.post(
+
+            f"{QDRANT_URL}/collections/{ANSWER_CACHE_COLLECTION}/points/delete",
+
+            json={"filter": _answer_cache_filter()},
+
+            timeout=(CONNECT_TIMEOUT, QDRANT_TIMEOUT),
+
+        )
+
+    except requests.exceptions.RequestException:
+
+        pass
+
+
+
+
+
+# ---------------------------------------------------------
+
+# Math detection + extraction helpers
+
+# ---------------------------------------------------------
+
+# re.ASCII: keys are ASCII, so skip Unicode case folding (e.g. "ſ" matching "s")
+
+_salary_re = re.compile(r"\bBASICSALARY\s*:\s*([0-9]+(?:\.[0-9]+)?)\b", re.IGNORECASE | re.ASCII)
+
+_name_re = re.compile(r"\bEMPLOYEENAME\s*:\s*([^|]+)", re.IGNORECASE | re.ASCII)
+
+
+
+# Payload keys, checked in order
+
+_EMP_KEYS = ("EMPLOYEEID", "employeeid", "employee_id", "EmployeeId")
+
+_SALARY_KEYS = ("BASICSALARY", "basicSalary", "SALARY", "salary")
+
+_NAME_KEYS = ("EMPLOYEENAME", "employee_name", "name", "EmployeeName")
+
+
+
+# Everything the salary aggregation reads; scrolls request only these fields
+
+_MATH_PAYLOAD_FIELDS = _EMP_KEYS + _SALARY_KEYS + _NAME_KEYS + ("prompt",)
+
+
+
+_AGG_KEYWORDS = (
+
+    "total", "sum", "average", "avg", "mean", "count",
+
+    "maximum", "max", "highest", "minimum", "min", "lowest",
+
+    "median", "top ", "top-"
+
+)
+
+_TARGET_KEYWORDS = ("employee", "employees", "salary", "basic", "basicsalary", "pay", "wage")
+
+
+
+# Keywords that pick the operation in _pick_math_op (all are agg/target keywords too)
+
+_OP_KEYWORDS = (
+
+    ("total", ("total", "sum")),
+
+    ("avg", ("average", "avg", "mean")),
+
+    ("count", ("count",)),
+
+    ("max", ("maximum", "max", "highest")),
+
+    ("min", ("minimum", "min", "lowest")),
+
+    ("salary", ("salary", "basic", "basicsalary")),
+
+    ("employee", ("employee", "employees")),
+
+)
+
+
+
+# What each keyword tells us: "agg"/"target" for _looks_like_global_aggregation,
+
+# the rest pick the operation in _pick_math_op
+
+_KEYWORD_GROUPS = (("agg", _AGG_KEYWORDS), ("target", _TARGET_KEYWORDS)) + _OP_KEYWORDS
+
+_KEYWORD_TAGS = {
+
+    kw: tuple(tag for tag, kws in _KEYWORD_GROUPS if kw in kws)
+
+    for _, kws in _KEYWORD_GROUPS
+
+    for kw in kws
+
+}
+
+
+
+# One scan finds every keyword as a substring (the lookahead reports overlapping
+
+# hits too, e.g. "basicsalary" and the "salary" inside it); longest first so a
+
+# shorter keyword at the same position only loses to one with the same tags.
+
+_MATH_KW_RE = re.compile(
+
+    "(?=(" + "|".join(re.escape(k) for k in sorted(_KEYWORD_TAGS, key=len, reverse=True)) + "))"
+
+)
+
+
+
+
+
+def _math_tags(question: str) -> set:
+
+    q = (question or "").lower()
+
+    return {tag for kw in _MATH_KW_RE.findall(q) for tag in _KEYWORD_TAGS[kw]}
+
+
+
+
+
+def _looks_like_global_aggregation(question: str) -> bool:
+
+    tags = _math_tags(question)
+
+    return "agg" in tags and "target" in tags
+
+
+
+
+
+def _pick_math_op(question: str) -> str:
+
+    tags = _math_tags(question)
+
+    if "salary" in tags:
+
+        for tag, op in (("max", "max_salary"), ("min", "min_salary"), ("total", "total_salary"), ("avg", "avg_salary")):
+
+            if tag in tags:
+
+                return op
+
+    if "count" in tags and "employee" in tags:
+
+        return "count_employees"
+
+    return "salary_stats"
+
+
+
+
+
+def _employee_key(payload: dict):
+
+    for key in _EMP_KEYS:
+
+        v = payload.get(key)
+
+        if v is None:
+
+            continue
+
+        v = v.strip() if type(v) is str else str(v).strip()
+
+        if v:
+
+            return v
+
+    return None
+
+
+
+
+
+def _extract_salary(payload: dict):
+
+    # Prefer structured field
+
+    for key in _SALARY_KEYS:
+
+        if key not in payload:
+
+            continue
+
+        v = payload[key]
+
+        if type(v) is float or type(v) is int:  # JSON numbers: no str round-trip (bool excluded)
+
+            try:
+
+                return float(v)
+
+            except OverflowError:
+
+                pass  # huge int: the string path below yields +-inf as before
+
+        v = str(v).strip()
+
+        if v != "":
+
+            try:
+
+                return float(v.replace(",", ""))
+
+            except Exception:
+
+                pass
+
+
+
+    # Fallback parse from prompt
+
+    txt = payload.get("prompt") or ""
+
+    m = _salary_re.search(txt)
+
+    if m:
+
+        try:
+
+            return float(m.group(1))
+
+        except Exception:
+
+            return None
+
+    return None
+
+
+
+
+
+def _extract_name(payload: dict):
+
+    for key in _NAME_KEYS:
+
+        v = payload.get(key)
+
+        if v is not None and str(v).strip() != "":
+
+            return str(v).strip()
+
+
+
+    txt = payload.get("prompt") or ""
+
+    m = _name_re.search(txt)
+
+    if m:
+
+        return (m.group(1) or "").strip()
+
+    return ""
+
+
+
+
+
+def _compute_salary_stats_from_points(points):
+
+    """
+
+    Computes exact statistics from ALL points (full scroll), in a single pass.
+
+    `points` may be any iterable (e.g. _qdrant_iter_points), so only the
+
+    dedupe set is held in memory.
+
+    Dedupe by EMPLOYEEID if present to avoid duplicates.
+
+    """
+
+    seen_emp = set()
+
+
+
+    points_scanned = 0
+
+    salary_sum = 0.0
+
+    salary_values_found = 0
+
+
+
+    # (salary, emp_id, payload); names are extracted only for the final winners
+
+    min_row = None
+
+    max_row = None
+
+
+
+    for p in points:
+
+        points_scanned += 1
+
+        payload = p.get("payload") or {}
+
+
+
+        emp_id = _employee_key(payload)
+
+        if emp_id:
+
+            if emp_id in seen_emp:
+
+                continue
+
+            seen_emp.add(emp_id)
+
+
+
+        sal = _extract_salary(payload)
+
+        if sal is None:
+
+            continue
+
+
+
+        salary_sum += sal
+
+        salary_values_found += 1
+
+
+
+        if min_row is None or sal < min_row[0]:
+
+            min_row = (sal, emp_id, payload)
+
+
+
+        if max_row is None or sal > max_row[0]:
+
+            max_row = (sal, emp_id, payload)
+
+
+
+    def employee(row):
+
+        if row is None:
+
+            return None
+
+        sal, emp_id, payload = row
+
+        return {"EMPLOYEEID": emp_id, "EMPLOYEENAME": _extract_name(payload), "BASICSALARY": sal}
+
+
+
+    employee_count = len(seen_emp) if seen_emp else salary_values_found
+
+    avg_salary = (salary_sum / employee_count) if employee_count else 0.0
+
+
+
+    return {
+
+        "employee_count": employee_count,
+
+        "salary_values_found": salary_values_found,
+
+        "total_salary": salary_sum,
+
+        "avg_salary": avg_salary,
+
+        "min_salary": min_row[0] if min_row else None,
+
+        "max_salary": max_row[0] if max_row else None,
+
+        "min_salary_employee": employee(min_row),
+
+        "max_salary_employee": employee(max_row),
+
+        "dedup_by_employeeid": bool(seen_emp),
+
+        "points_scanned": points_scanned,
+
+    }
+
+
+
+
+
+def _cached_salary_stats():
+
+    """
+
+    Full-scan salary stats for QDRANT_COLLECTION plus "collection_points_count",
+
+    "cached" and "stats_age_seconds" (how old the scan behind the numbers is;
+
+    points_scanned refers to that scan). Returns a fresh top-level dict each
+
+    call, so callers may add keys.
+
+    """
+
+    # Runs before the scan, not beside it: the count is part of the cache key,
+
+    # and a hit must be able to skip the scroll entirely
+
+    count = _cached_points_count()
+
+    key = (QDRANT_COLLECTION, _collection_version, count)
+
+    entry = _STATS_CACHE.get(key)
+
+    cached = entry is not None
+
+    if not cached:
+
+        points = _qdrant_iter_points(batch_size=QDRANT_SCROLL_BATCH, payload_fields=_MATH_PAYLOAD_FIELDS)
+
+        entry = (time.time(), _compute_salary_stats_from_points(points))
+
+        _STATS_CACHE.set(key, entry)
+
+    scanned_at, stats = entry
+
+    stats = dict(stats)
+
+    stats["collection_points_count"] = count
+
+    stats["cached"] = cached
+
+    stats["stats_age_seconds"] = round(time.time() - scanned_at, 1)
+
+    return stats
+
+
+
+
+
+# ---------------------------------------------------------
+
+# API: LLM-only chat (no RAG)
+
+# ---------------------------------------------------------
+
+_CHAT_HEADER = (
+
+    "You are a helpful assistant running privately on-prem.\n"
+
+    "Answer clearly and concisely.\n"
+
+    "\n"
+
+    "Conversation:"
+
+)
+
+
+
+
+
+@csrf_exempt
+
+@require_POST
+
+def api_chat(request):
+
+    try:
+
+        payload = _json_loads(request.body)
+
+        user_message = (payload.get("message") or "").strip()
+
+        history = payload.get("history") or []
+
+
+
+        if not user_message:
+
+            return _json_response({"error": "message is required"}, status=400)
+
+
+
+        # Newest first until the budget is spent, then back to chronological order
+
+        turns = []
+
+        budget = CHAT_HISTORY_BUDGET_CHARS
+
+        for m in reversed(history[-6:]):
+
+            content = (m.get("content") or "").strip()[:CHAT_HISTORY_MAX_CHARS]
+
+            if not content:
+
+                continue
+
+            if len(content) > budget:
+
+                break
+
+            budget -= len(content)
+
+            turns.append(("User: " if m.get("role") == "user" else "Assistant: ") + content)
+
+
+
+        # Assembled in one join straight from the pieces, no intermediate list
+
+        prompt = "\n".join(chain((_CHAT_HEADER,), reversed(turns), ("User: " + user_message, "Assistant:")))
+
+
+
+        if payload.get("stream"):
+
+            return _ndjson_stream(_ollama_generate_stream(prompt))
+
+
+
+        answer = _ollama_generate(prompt)
+
+        return _json_response({"answer": answer})
+
+
+
+    except requests.exceptions.RequestException as e:
+
+        return _json_response({"error": f"Upstream request failed: {str(e)}"}, status=502)
+
+    except Exception as e:
+
+        return _json_response({"error": str(e)}, status=500)
+
+
+
+
+
+# ---------------------------------------------------------
+
+# API: Math-only endpoint (FULL DATA always; meta.cached / stats_age_seconds)
+
+# ---------------------------------------------------------
+
+@csrf_exempt
+
+@require_POST
+
+def api_math(request):
+
+    """
+
+    POST JSON:
+
+      {"op":"salary_stats"|"total_salary"|"avg_salary"|"count_employees"|"max_salary"|"min_salary"}
+
+    Always computed over ALL points (scroll); the result is reused while the
+
+    collection is unchanged, for at most STATS_CACHE_TTL seconds (see
+
+    _cached_salary_stats). meta.cached / meta.stats_age_seconds say so.
+
+    """
+
+    try:
+
+        payload = _json_loads(request.body)
+
+        op = (payload.get("op") or "salary_stats").strip().lower()
+
+
+
+        stats = _cached_salary_stats()
+
+
+
+        if op == "count_employees":
+
+            return _json_response({"employee_count": stats["employee_count"], "meta": stats})
+
+
+
+        if op == "total_salary":
+
+            return _json_response({"total_salary": stats["total_salary"], "meta": stats})
+
+
+
+        if op == "avg_salary":
+
+            return _json_response(
+
+                {"avg_salary": stats["avg_salary"], "total_salary": stats["total_salary"], "meta": stats}
+
+            )
+
+
+
+        if op == "max_salary":
+
+            return _json_response({"max_salary": stats["max_salary"], "max_salary_employee": stats["max_salary_employee"], "meta": stats})
+
+
+
+        if op == "min_salary":
+
+            return _json_response({"min_salary": stats["min_salary"], "min_salary_employee": stats["min_salary_employee"], "meta": stats})
+
+
+
+        return _json_response(stats)
+
+
+
+    except requests.exceptions.RequestException as e:
+
+        return _json_response({"error": f"Upstream request failed: {str(e)}"}, status=502)
+
+    except Exception as e:
+
+        return _json_response({"error": str(e)}, status=500)
+
+
+
+
+
+# ---------------------------------------------------------
+
+# API: RAG (Math-first for aggregation questions)
+
+# ---------------------------------------------------------
+
+# Built once; the fixed instruction prefix is byte-identical across requests,
+
+# which lets Ollama reuse its KV cache for it.
+
+_RAG_TEMPLATE = """
+
+You answer ONLY from CONTEXT.
+
+If answer not in CONTEXT, say: .
+
+
+
+CONTEXT:
+
+{context}
+
+
+
+QUESTION:
+
+{question}
+
+
+
+Answer:
+
+""".strip()
+
+
+
+_MATH_RAG_TEMPLATE = """
+
+NUMERIC_RESULT (authoritative):
+
+{math_answer}
+
+
+
+Rules:
+
+- DO NOT recompute numbers (sum/avg/min/max/count) from CONTEXT.
+
+- Use CONTEXT only for explanation and a few examples.
+
+
+
+CONTEXT:
+
+{context}
+
+
+
+QUESTION:
+
+{question}
+
+
+
+Answer:
+
+""".strip()
+
+
+
+
+
+@csrf_exempt
+
+@require_POST
+
+def api_ask(request):
+
+    try:
+
+        payload = _json_loads(request.body)
+
+        question = (payload.get("question") or payload.get("message") or "").strip()
+
+        top_k = int(payload.get("top_k", 6))
+
+        stream = bool(payload.get("stream"))
+
+        explain = bool(payload.get("explain"))  # aggregation answers: add an LLM explanation
+
+
+
+        if not question:
+
+            return _json_response({"error": "question is required"}, status=400)
+
+
+
+        # ---------- FULL-SCAN MATH FIRST (when question is aggregation) ----------
+
+        if _looks_like_global_aggregation(question):
+
+            op = _pick_math_op(question)
+
+
+
+            # The RAG examples don't depend on the scan: fetch them meanwhile
+
+            hits_future = _IO_POOL.submit(_rag_hits, question, top_k) if explain else None
+
+
+
+            stats = _cached_salary_stats()
+
+            stats["math_op"] = op
+
+            stats["auto_flow"] = "FULL_SCAN_MATH_THEN_RAG" if explain else "FULL_SCAN_MATH"
+
+
+
+            # Exact numeric statement
+
+            if op == "total_salary":
+
+                math_answer = f"Total basic salary (ALL employees) = {stats['total_salary']}"
+
+            elif op == "avg_salary":
+
+                math_answer = f"Average basic salary (ALL employees) = {stats['avg_salary']}"
+
+            elif op == "count_employees":
+
+                math_answer = f"Employee count = {stats['employee_count']}"
+
+            elif op == "max_salary":
+
+                e = stats.get("max_salary_employee") or {}
+
+                math_answer = (
+
+                    f"Max basic salary = {stats['max_salary']} "
+
+                    f"(Employee: {e.get('EMPLOYEENAME','')} | ID: {e.get('EMPLOYEEID','')})"
+
+                )
+
+            elif op == "min_salary":
+
+                e = stats.get("min_salary_employee") or {}
+
+                math_answer = (
+
+                    f"Min basic salary = {stats['min_salary']} "
+
+                    f"(Employee: {e.get('EMPLOYEENAME','')} | ID: {e.get('EMPLOYEEID','')})"
+
+                )
+
+            else:
+
+                math_answer = (
+
+                    f"Employees={stats['employee_count']}, Total={stats['total_salary']}, "
+
+                    f"Avg={stats['avg_salary']}, Min={stats['min_salary']}, Max={stats['max_salary']}"
+
+                )
+
+
+
+            if not explain:
+
+                if stream:
+
+                    return _ndjson_stream([math_answer], tail={"sources": [], "math": stats})
+
+                return _json_response({"answer": math_answer, "sources": [], "math": stats})
+
+
+
+            # RAG examples (Top-K) for explanation only
+
+            hits = hits_future.result()
+
+
+
+            context, sources = _rag_context(hits)
+
+
+
+            rag_prompt = _MATH_RAG_TEMPLATE.format(math_answer=math_answer, context=context, question=question)
+
+
+
+            heading = f"{math_answer}\n\nExplanation/examples (Top-{top_k}):\n"
+
+            if stream:
+
+                # The exact numbers go out first, the explanation follows as it is generated
+
+                return _ndjson_stream(
+
+                    chain([heading], _ollama_generate_stream(rag_prompt)),
+
+                    tail={"sources": sources, "math": stats},
+
+                )
+
+
+
+            explanation = _ollama_generate(rag_prompt)
+
+            final_answer = heading + explanation
+
+
+
+            return _json_response({"answer": final_answer, "sources": sources, "math": stats})
+
+
+
+        # ---------- NORMAL RAG ----------
+
+        vec = _cached_query_embedding(question)
+
+
+
+        cached = _answer_cache_lookup(vec, top_k)
+
+        if cached is not None:
+
+            if stream:
+
+                tail = {"sources": cached.get("sources") or [], "auto_flow": "RAG_ONLY", "cached": True}
+
+                return _ndjson_stream([cached["answer"]], tail=tail)
+
+            return _json_response(
+
+                {
+
+                    "answer": cached["answer"],
+
+                    "sources": cached.get("sources") or [],
+
+                    "auto_flow": "RAG_ONLY",
+
+                    "cached": True,
+
+                }
+
+            )
+
+
+
+        hits = _cached_qdrant_query(vec, limit=top_k)
+
+        hits = _dedupe_hits(hits)
+
+
+
+        context, sources = _rag_context(hits)
+
+
+
+        rag_prompt = _RAG_TEMPLATE.format(context=context, question=question)
+
+
+
+        if stream:
+
+            return _ndjson_stream(
+
+                _ollama_generate_stream(rag_prompt),
+
+                tail={"sources": sources, "auto_flow": "RAG_ONLY"},
+
+                on_done=lambda answer: _answer_cache_store(vec, question, answer, sources, top_k),
+
+            )
+
+
+
+        answer = _ollama_generate(rag_prompt)
+
+        _answer_cache_store(vec, question, answer, sources, top_k)
+
+        return _json_response({"answer": answer, "sources": sources, "auto_flow": "RAG_ONLY"})
+
+
+
+    except requests.exceptions.RequestException as e:
+
+        return _json_response({"error": f"Upstream request failed: {str(e)}"}, status=502)
+
+    except Exception as e:
+
+        return _json_response({"error": str(e)}, status=500)
+
+
+
+
+
+# ---------------------------------------------------------
+
+# NiFi -> JSONL export helpers
+
+# ---------------------------------------------------------
+
+def build_prompt_all_fields(obj: dict) -> str:
+
+    parts = []
+
+    total = -3  # joined length so far; the first part adds no " | "
+
+    for k, v in obj.items():
+
+        if v is None:
+
+            continue
+
+        if isinstance(v, str):
+
+            if not v.strip():
+
+                continue
+
+        elif isinstance(v, (dict, list)):
+
+            v = json.dumps(v, ensure_ascii=False)
+
+        part = f"{k}: {v}"
+
+        parts.append(part)
+
+        total += len(part) + 3
+
+        if total > MAX_PROMPT_CHARS:
+
+            # The rest would be cut off anyway
+
+            break
+
+
+
+    prompt = " | ".join(parts)
+
+    if len(prompt) > MAX_PROMPT_CHARS:
+
+        prompt = prompt[:MAX_PROMPT_CHARS] + " &(truncated)"
+
+    return prompt
+
+
+
+
+
+@lru_cache(maxsize=8192)
+
+def _employee_uuid(emp: str) -> str:
+
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"employee:{emp}"))
+
+
+
+
+
+def stable_uuid_from_employee(obj: dict) -> str:
+
+    # The base string must stay byte-identical: these ids are Qdrant point ids,
+
+    # and a different hash input would duplicate every re-exported record.
+
+    emp = obj.get("EMPLOYEEID")
+
+    emp = str(emp).strip() if emp is not None else ""
+
+    if emp:
+
+        return _employee_uuid(emp)
+
+    # Whole-record fallback: effectively unique per record, not worth caching
+
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, json.dumps(obj, sort_keys=True, ensure_ascii=False)))
+
+
+
+
+
+def _nifi_actor_records(r):
+
+    """
+
+    Yield the actor dicts of a NiFi response opened with stream=True.
+
+    A top-level JSON array is parsed incrementally with ijson when it is
+
+    installed; anything else (or no ijson) is parsed in one go.
+
+    """
+
+    with r:
+
+        chunks = r.iter_content(chunk_size=EXPORT_CHUNK_BYTES)
+
+        head = b""
+
+        for head in chunks:
+
+            if head.strip():
+
+                break
+
+
+
+        if ijson is not None and head.lstrip().startswith(b"["):
+
+            items = ijson.sendable_list()
+
+            coro = ijson.items_coro(items, "item", use_float=True)
+
+            coro.send(head)
+
+            for chunk in chunks:
+
+                yield from items
+
+                del items[:]
+
+                coro.send(chunk)
+
+            coro.close()
+
+            yield from items
+
+            return
+
+
+
+        data = _json_loads(head + b"".join(chunks))
+
+
+
+    if not isinstance(data, list):
+
+        data = [data] if isinstance(data, dict) else []
+
+    yield from data
+
+
 
 
 
-        if not user_message:
+def export_actors_jsonl(request):
 
-            return JsonResponse({"error": "message is required"}, status=400)
+    try:
 
+        r = _NIFI_SESSION.get(NIFI_URL, timeout=(CONNECT_TIMEOUT, 180), stream=True)
 
+        if not r.ok:
 
-        parts = [
+            r.close()
 
-            "You are a helpful assistant running privately on-prem.",
+            r.raise_for_status()
 
-            "Answer clearly and concisely.",
+        records = _nifi_actor_records(r)
 
-            "",
+        first = next(records, None)  # surface a bad / empty-body NiFi reply here, not mid-download
 
-            "Conversation:",
+    except Exception as e:
 
-        ]
+        return HttpResponseServerError(f"NiFi API error: {e}")
 
 
 
-        for m in history[-6:]:
+    data = (x for x in chain((first,), records) if isinstance(x, dict) and x)
 
-            role = m.get("role")
 
-            content = (m.get("content") or "").strip()
 
-            if not content:
+    def stream():
 
-                continue
+        # Emit ~EXPORT_CHUNK_BYTES blocks instead of one tiny chunk per line
 
-            parts.append(("User: " if role == "user" else "Assistant: ") + content)
+        buf = bytearray()
 
+        for obj in data:
 
+            line = {
 
-        parts.append("User: " + user_message)
+                "id": stable_uuid_from_employee(obj),
 
-        parts.append("Assistant:")
+                "prompt": build_prompt_all_fields(obj),
 
+                "source": "nifi_actors",
 
+            }
 
-        answer = _ollama_generate("\n".join(parts))
+            buf += _json_dumps_bytes(line)
 
-        return JsonResponse({"answer": answer})
+            buf += b"\n"
 
+            if len(buf) >= EXPORT_CHUNK_BYTES:
 
+                yield bytes(buf)
 
-    except requests.exceptions.RequestException as e:
+                buf.clear()
 
-        return JsonResponse({"error": f"Upstream request failed: {str(e)}"}, status=502)
+        if buf:
 
-    except Exception as e:
+            yield bytes(buf)
 
-        return JsonResponse({"error": str(e)}, status=500)
 
 
+    resp = StreamingHttpResponse(stream(), content_type="application/x-ndjson; charset=utf-8")
 
+    resp["Content-Disposition"] = 'attachment; filename="actors_uuid_for_rag.jsonl"'
 
+    resp["Cache-Control"] = "no-store"
 
-# ---------------------------------------------------------
+    return resp
 
-# API: Math-only endpoint (FULL DATA always)
 
-# ---------------------------------------------------------
 
-@csrf_exempt
 
-def api_math(request):
 
-    """
+# ---------------------------------------------------------
 
-    POST JSON:
+# JSONL upload helpers (adaptive embed batching)
 
-      {"op":"salary_stats"|"total_salary"|"avg_salary"|"count_employees"|"max_salary"|"min_salary"}
+# ---------------------------------------------------------
 
-    Always scans ALL points (scroll).
+class _AdaptiveBatcher:
 
     """
 
-    if request.method != "POST":
+    Embed batch size for one upload: doubles after `grow_after` successful
 
-        return JsonResponse({"error": "POST required"}, status=405)
+    requests in a row, halves on overload, clamped to [minimum, maximum].
 
+    """
 
 
-    try:
 
-        payload = json.loads(request.body.decode("utf-8"))
+    def __init__(self, initial, minimum=EMBED_BATCH_MIN, maximum=EMBED_BATCH_MAX, grow_after=4):
 
-        op = (payload.get("op") or "salary_stats").strip().lower()
+        self.minimum = max(1, minimum)
 
+        self.maximum = max(self.minimum, maximum)
 
+        self.size = min(max(int(initial), self.minimum), self.maximum)
 
-        points = _qdrant_scroll_all(batch_size=200)
+        self.grow_after = grow_after
 
-        stats = _compute_salary_stats_from_points(points)
+        self._successes = 0
 
-        stats["points_scanned"] = len(points)
+        self._lock = threading.Lock()
 
-        stats["collection_points_count"] = _qdrant_points_count()
 
 
+    def success(self):
 
-        if op == "count_employees":
+        with self._lock:
 
-            return JsonResponse({"employee_count": stats["employee_count"], "meta": stats})
+            self._successes += 1
 
+            if self._successes >= self.grow_after:
 
+                self._successes = 0
 
-        if op == "total_salary":
+                self.size = min(self.size * 2, self.maximum)
 
-            return JsonResponse({"total_salary": stats["total_salary"], "meta": stats})
 
 
+    def failure(self):
 
-        if op == "avg_salary":
+        with self._lock:
 
-            return JsonResponse(
+            self._successes = 0
 
-                {"avg_salary": stats["avg_salary"], "total_salary": stats["total_salary"], "meta": stats}
+            self.size = max(self.size // 2, self.minimum)
 
-            )
 
 
 
-        if op == "max_salary":
 
-            return JsonResponse({"max_salary": stats["max_salary"], "max_salary_employee": stats["max_salary_employee"], "meta": stats})
+def _sniff_jsonl(head: bytes) -> bool:
 
+    """
 
+    False if the first non-blank line of `head` is complete and is not a JSON
 
-        if op == "min_salary":
+    object. A first line longer than the sniffed bytes gets the benefit of the doubt.
 
-            return JsonResponse({"min_salary": stats["min_salary"], "min_salary_employee": stats["min_salary_employee"], "meta": stats})
+    """
 
+    cut = len(head) >= UPLOAD_SNIFF_BYTES
 
+    if head.startswith(_UTF8_BOM):
 
-        return JsonResponse(stats)
+        head = head[len(_UTF8_BOM):]  # orjson rejects it; json.loads(bytes) would not
 
+    lines = head.split(b"\n")
 
+    for i, line in enumerate(lines):
 
-    except requests.exceptions.RequestException as e:
+        line = line.strip()
 
-        return JsonResponse({"error": f"Upstream request failed: {str(e)}"}, status=502)
+        if not line:
 
-    except Exception as e:
+            continue
 
-        return JsonResponse({"error": str(e)}, status=500)
+        if i == len(lines) - 1 and cut:
 
+            return True  # truncated by the sniff window
 
+        try:
 
+            return isinstance(_json_loads(line), dict)
 
+        except ValueError:
 
-# ---------------------------------------------------------
+            return False
 
-# API: RAG (Math-first for aggregation questions)
+    return True
 
-# ---------------------------------------------------------
 
-@csrf_exempt
 
-def api_ask(request):
 
-    if request.method != "POST":
 
-        return JsonResponse({"error": "POST required"}, status=405)
+def _is_overload(e):
 
+    # Timeouts and 5xx mean "too much at once": worth retrying smaller.
 
+    if isinstance(e, requests.exceptions.Timeout):
 
-    try:
+        return True
 
-        payload = json.loads(request.body.decode("utf-8"))
+    resp = getattr(e, "response", None)
 
-        question = (payload.get("question") or payload.get("message") or "").strip()
+    return isinstance(e, requests.exceptions.HTTPError) and resp is not None and resp.status_code >= 500
 
-        top_k = int(payload.get("top_k", 6))
 
 
 
-        if not question:
 
-            return JsonResponse({"error": "question is required"}, status=400)
+def _embed_adaptive(batcher, model: str, texts):
 
+    """Embed texts in one request; on overload, shrink the batch and retry each half."""
 
+    try:
 
-        # ---------- FULL-SCAN MATH FIRST (when question is aggregation) ----------
+        embs = _ollama_embed_batch(model, texts)
 
-        if _looks_like_global_aggregation(question):
+    except Exception as e:
 
-            op = _pick_math_op(question)
+        if len(texts) <= 1 or not _is_overload(e):
 
+            raise
 
+        batcher.failure()
 
-            points = _qdrant_scroll_all(batch_size=200)
+        mid = len(texts) // 2
 
-            stats = _compute_salary_stats_from_points(points)
+        return _embed_adaptive(batcher, model, texts[:mid]) + _embed_adaptive(batcher, model, texts[mid:])
 
-            stats["points_scanned"] = len(points)
+    batcher.success()
 
-            stats["collection_points_count"] = _qdrant_points_count()
+    return embs
 
-            stats["math_op"] = op
 
-            stats["auto_flow"] = "FULL_SCAN_MATH_THEN_RAG"
 
 
 
-            # Exact numeric statement
+def _is_rejected(e):
 
-            if op == "total_salary":
+    # 4xx: Qdrant refused the request itself (bad point id, wrong vector size)
 
-                math_answer = f"Total basic salary (ALL employees) = {stats['total_salary']}"
+    resp = getattr(e, "response", None)
 
-            elif op == "avg_salary":
+    return isinstance(e, requests.exceptions.HTTPError) and resp is not None and 400 <= resp.status_code < 500
 
-                math_answer = f"Average basic salary (ALL employees) = {stats['avg_salary']}"
 
-            elif op == "count_employees":
 
-                math_answer = f"Employee count = {stats['employee_count']}"
 
-            elif op == "max_salary":
 
-                e = stats.get("max_salary_employee") or {}
+def _upsert_isolating(collection: str, chunk, wait=False):
 
-                math_answer = (
+    """
 
-                    f"Max basic salary = {stats['max_salary']} "
+    Upsert (line_no, point) pairs in one request. Qdrant rejects a whole request
 
-                    f"(Employee: {e.get('EMPLOYEENAME','')} | ID: {e.get('EMPLOYEEID','')})"
+    over a single bad point, so on a 4xx split it and retry each half until only
 
-                )
+    the offending points fail. Returns the failed (sub)chunks as [(chunk, error)].
 
-            elif op == "min_salary":
+    """
 
-                e = stats.get("min_salary_employee") or {}
+    try:
 
-                math_answer = (
+        _qdrant_upsert_batch(collection, [pt for _ln, pt in chunk], wait=wait)
 
-                    f"Min basic salary = {stats['min_salary']} "
+        return []
 
-                    f"(Employee: {e.get('EMPLOYEENAME','')} | ID: {e.get('EMPLOYEEID','')})"
+    except Exception as e:
 
-                )
+        if len(chunk) <= 1 or not _is_rejected(e):
 
-            else:
+            return [(chunk, e)]
 
-                math_answer = (
+    mid = len(chunk) // 2
 
-                    f"Employees={stats['employee_count']}, Total={stats['total_salary']}, "
+    return _upsert_isolating(collection, chunk[:mid]) + _upsert_isolating(collection, chunk[mid:], wait=wait)
 
-                    f"Avg={stats['avg_salary']}, Min={stats['min_salary']}, Max={stats['max_salary']}"
 
-                )
 
 
 
-            # RAG examples (Top-K) for explanation only
+def _embed_unique_texts(keys, batcher):
 
-            vec = _ollama_embeddings(question)
+    """
 
-            hits = _qdrant_search(vec, limit=top_k)
+    Embed (model, text) keys. Returns one vector (or the raised exception) per key.
 
-            hits = _dedupe_hits(hits)
+    Texts of the same model go batcher.size at a time, re-read for every request,
 
+    with up to EMBED_CONCURRENCY requests in flight.
 
+    """
 
-            ctx_blocks = []
+    results = [None] * len(keys)
 
-            sources = []
+    if not keys:
 
-            for i, h in enumerate(hits, 1):
+        return results
 
-                p = h.get("payload") or {}
 
-                txt = (p.get("prompt") or "").strip()
 
-                if not txt:
+    by_model = {}
 
-                    continue
+    for u, (model, _text) in enumerate(keys):
 
-                ctx_blocks.append(f"[{i}] {txt}")
+        by_model.setdefault(model, []).append(u)
 
-                sources.append({"id": h.get("id"), "score": h.get("score")})
+    todo = [[model, idxs, 0] for model, idxs in by_model.items()]
 
 
 
-            context = "\n\n".join(ctx_blocks)
+    def next_job():
 
+        while todo:
 
+            model, idxs, pos = todo[0]
 
-            rag_prompt = f"""
+            if pos >= len(idxs):
 
-NUMERIC_RESULT (authoritative):
+                todo.pop(0)
 
-{math_answer}
+                continue
 
+            end = pos + batcher.size
 
+            todo[0][2] = end
 
-Rules:
+            return model, idxs[pos:end]
 
-- DO NOT recompute numbers (sum/avg/min/max/count) from CONTEXT.
+        return None
 
-- Use CONTEXT only for explanation and a few examples.
 
 
+    with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as pool:
 
-CONTEXT:
+        in_flight = {}
 
-{context}
+        while True:
 
+            while len(in_flight) < EMBED_CONCURRENCY:
 
+                job = next_job()
 
-QUESTION:
+                if job is None:
 
-{question}
+                    break
 
+                model, chunk = job
 
+                texts = [keys[u][1] for u in chunk]
 
-Answer:
+                in_flight[pool.submit(_embed_adaptive, batcher, model, texts)] = chunk
 
-""".strip()
+            if not in_flight:
 
+                break
 
 
-            explanation = _ollama_generate(rag_prompt)
 
-            final_answer = f"{math_answer}\n\nExplanation/examples (Top-{top_k}):\n{explanation}"
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
 
+            for fut in done:
 
+                chunk = in_flight.pop(fut)
 
-            return JsonResponse({"answer": final_answer, "sources": sources, "math": stats})
+                try:
 
+                    embs = fut.result()
 
+                except Exception as e:
 
-        # ---------- NORMAL RAG ----------
+                    embs = [e] * len(chunk)
 
-        vec = _ollama_embeddings(question)
+                for u, vec in zip(chunk, embs):
 
-        hits = _qdrant_search(vec, limit=top_k)
+                    results[u] = vec
 
-        hits = _dedupe_hits(hits)
 
 
+    return results
 
-        ctx_blocks = []
 
-        sources = []
 
-        for i, h in enumerate(hits, 1):
 
-            p = h.get("payload") or {}
 
-            txt = (p.get("prompt") or "").strip()
+# ---------------------------------------------------------
 
-            if not txt:
+# API: Upload JSONL -> embed -> upsert to Qdrant
 
-                continue
+# ---------------------------------------------------------
 
-            ctx_blocks.append(f"[{i}] {txt}")
+@csrf_exempt
 
-            sources.append({"id": h.get("id"), "score": h.get("score")})
+@require_POST
 
+def api_upload_jsonl(request):
 
+    """
 
-        context = "\n\n".join(ctx_blocks)
+    Upload a JSONL file and upsert into Qdrant using Ollama embeddings.
 
+    Each line: JSON with at least {"prompt":"..."}.
 
+    Optional: model, id, dw_id. If no id provided => UUID.
 
-        rag_prompt = f"""
+    Form fields: collection, embed_model, batch_size (initial embed batch size),
 
-You answer ONLY from CONTEXT.
+    progress=1 (stream NDJSON: one {"line","success","failed"} line per window,
 
-If answer not in CONTEXT, say: .
+    then the usual summary object as the last line).
 
+    """
 
+    try:
 
-CONTEXT:
+        if "file" not in request.FILES:
 
-{context}
+            return _json_response({"error": "file is required"}, status=400)
 
 
 
-QUESTION:
+        f = request.FILES["file"]
 
-{question}
+        if not f.name.lower().endswith(".jsonl"):
 
+            return _json_response({"error": "Only .jsonl is supported"}, status=400)
 
+        if f.size > MAX_UPLOAD_BYTES:
 
-Answer:
+            return _json_response({"error": f"File too large (max {MAX_UPLOAD_BYTES} bytes)"}, status=413)
 
-""".strip()
 
 
+        # Fail fast on files that are not JSONL at all, before any embedding work
 
-        answer = _ollama_generate(rag_prompt)
+        head = f.read(UPLOAD_SNIFF_BYTES)
 
-        return JsonResponse({"answer": answer, "sources": sources, "auto_flow": "RAG_ONLY"})
+        f.seek(0)
 
+        if not _sniff_jsonl(head):
 
+            return _json_response({"error": "Not valid JSONL: first line is not a JSON object"}, status=400)
 
-    except requests.exceptions.RequestException as e:
 
-        return JsonResponse({"error": f"Upstream request failed: {str(e)}"}, status=502)
 
-    except Exception as e:
+        collection = (request.POST.get("collection") or QDRANT_COLLECTION).strip()
 
-        return JsonResponse({"error": str(e)}, status=500)
+        embed_model = (request.POST.get("embed_model") or EMBED_MODEL).strip()
 
+        try:
 
+            batch_size = int(request.POST.get("batch_size") or EMBED_BATCH_INIT)
 
+        except ValueError:
 
+            return _json_response({"error": "batch_size must be an integer"}, status=400)
 
-# ---------------------------------------------------------
 
-# NiFi -> JSONL export helpers
 
-# ---------------------------------------------------------
+        ok = 0
 
-def build_prompt_all_fields(obj: dict) -> str:
+        failed = 0
 
-    parts = []
+        errors = []
 
-    for k, v in obj.items():
+        truncated = False  # error list full: stop parsing, record nothing more
 
-        if v is None:
 
-            continue
 
-        if isinstance(v, str) and v.strip() == "":
+        def record_error(ln, e):
 
-            continue
+            nonlocal truncated
 
-        if isinstance(v, (dict, list)):
+            if truncated:
 
-            v = json.dumps(v, ensure_ascii=False)
+                return
 
-        parts.append(f"{k}: {v}")
+            errors.append({"line": ln, "error": str(e)})
 
+            if len(errors) == 30:
 
+                errors.append({"line": ln, "error": "Too many errors; truncated."})
 
-    prompt = " | ".join(parts)
+                truncated = True
 
-    if len(prompt) > MAX_PROMPT_CHARS:
 
-        prompt = prompt[:MAX_PROMPT_CHARS] + " &(truncated)"
 
-    return prompt
+        def flush(rows):
 
+            # Embed + upsert one window of parsed rows
 
+            nonlocal ok, failed
 
 
 
-def stable_uuid_from_employee(obj: dict) -> str:
+            # 2) Embed each distinct (model, text) once; duplicate rows share the vector.
 
-    emp = obj.get("EMPLOYEEID")
+            uniq = {}  # (model, text) -> index into uniq_keys
 
-    if emp is not None and str(emp).strip() != "":
+            uniq_keys = []
 
-        base = f"employee:{str(emp).strip()}"
+            row_uniq = []
 
-    else:
+            for _ln, _pid, _doc, text, model in rows:
 
-        base = json.dumps(obj, sort_keys=True, ensure_ascii=False)
+                key = (model, text)
 
-    return str(uuid.uuid5(uuid.NAMESPACE_DNS, base))
+                u = uniq.get(key)
 
+                if u is None:
 
+                    u = uniq[key] = len(uniq_keys)
 
+                    uniq_keys.append(key)
 
+                row_uniq.append(u)
 
-def export_actors_jsonl(request):
 
-    try:
 
-        r = requests.get(NIFI_URL, timeout=180)
+            uniq_vectors = _embed_unique_texts(uniq_keys, batcher)
 
-        r.raise_for_status()
+            uniq_vectors = [v if isinstance(v, Exception) else _wire_vector(v) for v in uniq_vectors]
 
-        data = r.json()
+            vectors = [uniq_vectors[u] for u in row_uniq]
 
-    except Exception as e:
 
-        return HttpResponseServerError(f"NiFi API error: {e}")
 
+            # 3) Upsert in original line order, QDRANT_UPSERT_BATCH points per request.
 
+            #    Only the window's final request waits for Qdrant to apply the writes,
 
-    if not isinstance(data, list):
+            #    which also keeps Qdrant's update queue from running ahead of us.
 
-        data = [data] if isinstance(data, dict) else []
+            pending = []
 
+            for (ln, pid, doc, _text, _model), vec in zip(rows, vectors):
 
+                if isinstance(vec, Exception):
 
-    data = [x for x in data if isinstance(x, dict) and x]
+                    failed += 1
 
+                    record_error(ln, vec)
 
+                    continue
 
-    def stream():
+                pending.append((ln, {"id": pid, "vector": vec, "payload": doc}))
 
-        for obj in data:
 
-            line = {
 
-                "id": stable_uuid_from_employee(obj),
+            for start in range(0, len(pending), QDRANT_UPSERT_BATCH):
 
-                "prompt": build_prompt_all_fields(obj),
+                chunk = pending[start:start + QDRANT_UPSERT_BATCH]
 
-                "source": "nifi_actors",
+                last = start + QDRANT_UPSERT_BATCH >= len(pending)
 
-            }
+                ok += len(chunk)
 
-            yield json.dumps(line, ensure_ascii=False) + "\n"
+                for part, e in _upsert_isolating(collection, chunk, wait=last):
 
+                    # One entry per failed request, covering its line range
 
+                    ok -= len(part)
 
-    resp = StreamingHttpResponse(stream(), content_type="application/x-ndjson; charset=utf-8")
+                    failed += len(part)
 
-    resp["Content-Disposition"] = 'attachment; filename="actors_uuid_for_rag.jsonl"'
+                    first_ln, last_ln = part[0][0], part[-1][0]
 
-    resp["Cache-Control"] = "no-store"
+                    record_error(first_ln, f"lines {first_ln}-{last_ln}: {e}" if last_ln != first_ln else e)
 
-    return resp
 
 
+        # 1) Parse: (line_no, pid, doc, text, model), flushed every UPLOAD_WINDOW_ROWS
 
+        #    rows so memory stays bounded however large the file is.
 
+        batcher = _AdaptiveBatcher(batch_size)  # clamped to [EMBED_BATCH_MIN, EMBED_BATCH_MAX]
 
-# ---------------------------------------------------------
 
-# API: Upload JSONL -> embed -> upsert to Qdrant
 
-# ---------------------------------------------------------
+        def run():
 
-@csrf_exempt
+            # Yields a progress dict after every full window, then the summary
 
-@require_POST
+            nonlocal failed
 
-def api_upload_jsonl(request):
+            rows = []
 
-    """
+            index_deferred = False
 
-    Upload a JSONL file and upsert into Qdrant using Ollama embeddings.
+            restore_threshold = None
 
-    Each line: JSON with at least {"prompt":"..."}.
+            try:
 
-    Optional: model, id, dw_id. If no id provided => UUID.
+                for ln, raw in enumerate(f, start=1):
 
-    """
+                    if ln == 1 and raw.startswith(_UTF8_BOM):
 
-    try:
+                        raw = raw[len(_UTF8_BOM):]
 
-        if "file" not in request.FILES:
+                    line = raw.strip()
 
-            return JsonResponse({"error": "file is required"}, status=400)
+                    if not line:
 
+                        continue
 
 
-        f = request.FILES["file"]
 
-        if not f.name.lower().endswith(".jsonl"):
+                    try:
 
-            return JsonResponse({"error": "Only .jsonl is supported"}, status=400)
+                        doc = _json_loads(line)
 
 
 
-        collection = (request.POST.get("collection") or QDRANT_COLLECTION).strip()
+                        text = (doc.get("prompt") or "").strip()
 
-        embed_model = (request.POST.get("embed_model") or EMBED_MODEL).strip()
+                        if not text:
 
+                            raise ValueError("missing 'prompt'")
 
 
-        ok = 0
 
-        failed = 0
+                        model = (doc.get("model") or embed_model).strip()
 
-        errors = []
+                        pid = str(doc.get("id") or doc.get("dw_id") or uuid.uuid4())
 
 
 
-        for ln, raw in enumerate(f, start=1):
+                        rows.append((ln, pid, doc, text, model))
 
-            line = raw.decode("utf-8", errors="ignore").strip()
 
-            if not line:
 
-                continue
+                    except Exception as e:
 
+                        failed += 1
 
+                        record_error(ln, e)
 
-            try:
+                        if truncated:
 
-                doc = json.loads(line)
+                            break
 
 
 
-                text = (doc.get("prompt") or "").strip()
+                    if len(rows) >= UPLOAD_WINDOW_ROWS:
 
-                if not text:
+                        if UPLOAD_DEFER_INDEXING and not index_deferred:
 
-                    raise ValueError("missing 'prompt'")
+                            # More than one window: bulk load without building HNSW on the way
 
+                            index_deferred = True
 
+                            restore_threshold = _qdrant_defer_indexing(collection)
 
-                model = (doc.get("model") or embed_model).strip()
+                        flush(rows)
 
-                pid = str(doc.get("id") or doc.get("dw_id") or uuid.uuid4())
+                        rows = []
 
+                        yield {"line": ln, "success": ok, "failed": failed}
 
+                        if truncated:
 
-                vec = _ollama_embeddings_with_model(model, text)
+                            break  # embed / upsert failures filled the error list
 
-                _qdrant_upsert(collection, pid, vec, doc)
 
 
+                if rows:
 
-                ok += 1
+                    flush(rows)
 
+            finally:
 
+                if restore_threshold is not None:
 
-            except Exception as e:
+                    try:
 
-                failed += 1
+                        _qdrant_set_indexing_threshold(collection, restore_threshold)
 
-                errors.append({"line": ln, "error": str(e)})
+                    except requests.exceptions.RequestException as e:
 
-                if len(errors) >= 30:
+                        errors.append({"line": 0, "error": f"Could not restore indexing_threshold={restore_threshold}: {e}"})
 
-                    errors.append({"line": ln, "error": "Too many errors; truncated."})
+                if ok:
 
-                    break
+                    # Also on client disconnect / mid-run errors: points already written
 
+                    _bump_collection_version()
 
 
-        return JsonResponse(
 
-            {
+            yield {
 
                 "success": ok,
 
@@ -1290,13 +3266,41 @@ def api_upload_jsonl(request):
 
             }
 
-        )
+
+
+        if request.POST.get("progress") in ("1", "true", "yes"):
+
+            def lines():
+
+                try:
+
+                    for item in run():
+
+                        yield _json_dumps_bytes(item) + b"\n"
+
+                except Exception as e:
+
+                    yield _json_dumps_bytes({"error": str(e)}) + b"\n"
+
+
+
+            return StreamingHttpResponse(lines(), content_type="application/x-ndjson; charset=utf-8")
+
+
+
+        summary = None
+
+        for summary in run():
+
+            pass
+
+        return _json_response(summary)
 
 
 
     except Exception as e:
 
-        return JsonResponse({"error": str(e)}, status=500)
+        return _json_response({"error": str(e)}, status=500)
 
 
 
@@ -1316,13 +3320,21 @@ QDRANT_VECTOR_SIZE = getattr(settings, "QDRANT_VECTOR_SIZE", 768)
 
 QDRANT_DISTANCE = getattr(settings, "QDRANT_DISTANCE", "Cosine")
 
+# Stored vector precision: "float16" halves vector storage vs "float32"
+
+QDRANT_VECTOR_DATATYPE = (getattr(settings, "QDRANT_VECTOR_DATATYPE", "float16") or "float32").strip().lower()
+
+# "scalar" (int8), "binary" or "" (plain float vectors)
+
+QDRANT_QUANTIZATION = (getattr(settings, "QDRANT_QUANTIZATION", "scalar") or "").strip().lower()
+
 
 
 
 
 def _qdrant_get_collection_info():
 
-    r = requests.get(f"{QDRANT_BASE}/collections/{ADMIN_COLLECTION}", timeout=30)
+    r = _QDRANT_SESSION.get(f"{QDRANT_BASE}/collections/{ADMIN_COLLECTION}", timeout=(CONNECT_TIMEOUT, 30))
 
     r.raise_for_status()
 
@@ -1332,9 +3344,27 @@ def _qdrant_get_collection_info():
 
 
 
+def _cached_collection_info():
+
+    key = ("info", QDRANT_BASE, ADMIN_COLLECTION, _collection_version)
+
+    info = _INFO_CACHE.get(key)
+
+    if info is None:
+
+        info = _qdrant_get_collection_info()
+
+        _INFO_CACHE.set(key, info)
+
+    return info
+
+
+
+
+
 def _qdrant_delete_collection():
 
-    r = requests.delete(f"{QDRANT_BASE}/collections/{ADMIN_COLLECTION}", timeout=30)
+    r = _QDRANT_SESSION.delete(f"{QDRANT_BASE}/collections/{ADMIN_COLLECTION}", timeout=(CONNECT_TIMEOUT, 30))
 
     if r.status_code not in (200, 404):
 
@@ -1346,17 +3376,43 @@ def _qdrant_delete_collection():
 
 
 
+def _qdrant_quantization_config():
+
+    if QDRANT_QUANTIZATION == "scalar":
+
+        return {"scalar": {"type": "int8", "quantile": 0.99, "always_ram": True}}
+
+    if QDRANT_QUANTIZATION == "binary":
+
+        return {"binary": {"always_ram": True}}
+
+    return None
+
+
+
+
+
 def _qdrant_create_collection():
 
     payload = {"vectors": {"size": QDRANT_VECTOR_SIZE, "distance": QDRANT_DISTANCE}}
 
-    r = requests.put(
+    if QDRANT_VECTOR_DATATYPE != "float32":
+
+        payload["vectors"]["datatype"] = QDRANT_VECTOR_DATATYPE
+
+    quantization = _qdrant_quantization_config()
+
+    if quantization:
+
+        payload["quantization_config"] = quantization
+
+    r = _QDRANT_SESSION.put(
 
         f"{QDRANT_BASE}/collections/{ADMIN_COLLECTION}",
 
         json=payload,
 
-        timeout=30,
+        timeout=(CONNECT_TIMEOUT, 30),
 
     )
 
@@ -1424,6 +3480,8 @@ def qdrant_admin(request):
 
                 error = f"Qdrant operation failed: {e}"
 
+            _bump_collection_version()
+
 
 
         return redirect("qdrant_admin")
@@ -1434,7 +3492,7 @@ def qdrant_admin(request):
 
     try:
 
-        info = _qdrant_get_collection_info()
+        info = _cached_collection_info()
 
     except Exception as e:
 
@@ -1452,6 +3510,10 @@ def qdrant_admin(request):
 
         "distance": QDRANT_DISTANCE,
 
+        "quantization": QDRANT_QUANTIZATION,
+
+        "datatype": QDRANT_VECTOR_DATATYPE,
+
         "info": info,
 
         "message": message,